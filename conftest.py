@@ -1,4 +1,9 @@
 from pathlib import Path
 
 def pytest_addoption(parser):
-    parser.addoption('--profile', type=Path)
\ No newline at end of file
+    parser.addoption('--profile', type=Path)
+    parser.addoption('--large', action='store_true', help='also run the tests generating large synthetic projects')
+    parser.addoption('--benchmark', action='store_true', help='run the generation benchmarks (tests/benchmark_test.py)')
+    parser.addoption('--benchmark-baseline', type=Path, default=Path(__file__).parent / 'tests' / 'benchmark_baseline.json', help='measures the benchmarks are compared with')
+    parser.addoption('--benchmark-save', action='store_true', help='save the measures of the benchmarks in --benchmark-baseline')
+    parser.addoption('--benchmark-tolerance', type=float, default=1.5, help='ratio to its baseline above which a measure is a regression')
@@ -0,0 +1,3 @@
+from .genjutsu import main
+
+main()
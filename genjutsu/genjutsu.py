@@ -2,25 +2,50 @@
 from argparse import ArgumentParser
 from collections import namedtuple, OrderedDict
 from collections.abc import Callable, Iterable
-from contextlib import ExitStack, contextmanager, suppress
-from functools import lru_cache, partial, reduce
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager, nullcontext, suppress
+from contextvars import ContextVar, copy_context
+from fnmatch import translate
+from functools import lru_cache, partial
+from hashlib import sha256
 from importlib.machinery import SourceFileLoader
+from importlib.util import source_hash, MAGIC_NUMBER
 from inspect import stack
-from itertools import chain, groupby, repeat
+from itertools import chain, count
+import json
+from locale import getpreferredencoding
 import logging.config
+import marshal
+from multiprocessing import get_all_start_methods, get_context, AuthenticationError
+from multiprocessing.connection import Client, Listener
+import builtins
+import io
 from operator import itemgetter
-from os import environ, pathsep
-from os.path import expandvars
+from os import altsep, cpu_count, environ, fsdecode, getpid, name as os_name, open as os_open, pathsep, sep, replace, scandir, stat, urandom, O_RDWR, O_WRONLY, PathLike
+from os.path import exists, expandvars, isdir, join, relpath
+try:
+    from os import sched_getaffinity
+except ImportError:  # not on Windows and macOS
+    sched_getaffinity = None
+try:
+    from os import sysconf
+except ImportError:  # not on Windows
+    sysconf = None
 from pathlib import Path, PurePath
-from sys import getprofile, setprofile
+import re
+from signal import signal, SIGTERM
+from stat import S_ISDIR
 import sys
+from threading import Lock, RLock, get_ident
+from time import perf_counter_ns, time_ns
+from types import CodeType
 from typing import AbstractSet, Any, Callable, Iterable, Iterator, Union
 from uuid import uuid4
 
 if __name__ == '__main__' and __package__ is None:
     __package__ = 'genjutsu'  # pylint: disable=redefined-builtin
 
-assert sys.version_info > (3, 6)
+assert sys.version_info >= (3, 7)
 
 __version__ = '1.0.0+20170613.0'
 
@@ -29,12 +54,33 @@ _LOADED_TOOLSETS = ()
 _RESOURCE_DIR = Path(__file__).parent / 'resources'
 _RESOURCE_PATH = tuple(chain(expandvars(environ.get('GENJUTSU_RESOURCE_PATH', '')).split(pathsep), (Path.cwd(), _RESOURCE_DIR)))
 
-_BUILD_DIR = None
+_BUILD_DIR = None  # see --builddir
+_ENV_BUILD_DIR = 'build'  # build directory of the environments, relative to their prjdef, unless given to :class:`Env`
+_HOIST_FLAGS = False  # see --hoist-flags
+_SHARD = False  # see --shard
+_COMPDB = None  # see --compdb and --compdb-shards: None, 'flavour' (a compilation database per flavour) or 'env' (per flavour and first class environment)
+_COMPDB_RULES = frozenset(('cxx',))  # rules of the targets listed by the compilation databases
+_COMPDB_FILE = 'compile_commands.json'
+_TRACKING = ContextVar('_TRACKING', default=())  # environments recording the files read by the prjdefs being executed by the context, innermost last
+_TRACER = None  # :class:`_Tracer` recording the spans of the current run, if --timings or --trace
+_GENERATION = None  # (graph, environments, pid of the parent) of the parallel :func:`generate` in progress, inherited by the forked workers
+_RESOLVED_PATHS = 1 << 14  # paths cached by a _Resolver, beyond which the cache starts again: the memory of the generation stays bounded
+_CODE_CACHE = {}  # (path, mtime_ns, size): code object, see :func:`compile_cached`
+_BYTECODE_DIR = None  # directory of the .pyc files of :func:`compile_cached` (set by :func:`main` to __pycache__ in --builddir, or else in the build directory of the root environment), None to keep code in memory only
+_PRJDEFS = {}  # (path, kwargs): future namespace of the prjdefs evaluated (or being evaluated) by the current parse, kept between the generations of a daemon
+_PRJDEFS_LOCK = Lock()
+_PRJDEF_EXECUTOR = None  # see :func:`_prjdef_executor`
+_EVALUATING = {}  # key of :data:`_PRJDEFS`: thread evaluating it
+_WAITING = {}  # thread: key of :data:`_PRJDEFS` it waits for
+_CACHE_FILE = '.genjutsu_cache'
+_INDEX_FILE = '.genjutsu_index'
+_DAEMON_FILE = '.genjutsu_daemon'
+_NEUTRAL_OPTIONS = {'no_cache', 'jobs', 'persist_index', 'timings', 'trace', 'daemon', 'client'}  # command line options without effect on the generated files, left out of the cache key
 
 _Variable = namedtuple('_Variable', ('name', 'value', 'append'))
 _Flavour = namedtuple('_Flavour', ('name', 'flags'))
-_Target = namedtuple('_Target', ('env', 'inputs', 'implicit_inputs', 'order_only_inputs' , 'rule', 'flags', 'outputs', 'implicit_outputs', 'output_flags'))
 _Filter = namedtuple('_Filter', ('inputs', 'outputs'))
+_Pool = namedtuple('_Pool', ('name', 'depth', 'job_memory'))
 
 _Ninja = namedtuple('_Ninja', ('includes', 'subninjas', 'variables', 'builds', 'defaults'))
 
@@ -44,6 +90,25 @@ Variable, Flag = partial(_Variable, append=False), partial(_Variable, append=Tru
 DEFAULT_FLAVOUR = _Flavour('default', ())
 
 
+class _Target(object):
+    ''' Node of the graph of dependencies, see :func:`Target`
+
+        A record without per-instance dictionary, compared and hashed by identity: a target is referenced by every target depending on it,
+        comparing field by field would walk the whole upstream graph.
+    '''
+    __slots__ = ('env', 'inputs', 'implicit_inputs', 'order_only_inputs', 'rule', 'flags', 'outputs', 'implicit_outputs', 'output_flags')
+
+    def __init__(self, env, inputs, implicit_inputs, order_only_inputs, rule, flags, outputs, implicit_outputs, output_flags):  # pylint:disable=redefined-outer-name,too-many-arguments
+        self.env, self.inputs, self.implicit_inputs, self.order_only_inputs, self.rule = env, inputs, implicit_inputs, order_only_inputs, rule
+        self.flags, self.outputs, self.implicit_outputs, self.output_flags = flags, outputs, implicit_outputs, output_flags
+
+    def _replace(self, **kwargs):
+        return _Target(**dict(((name, getattr(self, name)) for name in self.__slots__), **kwargs))
+
+    def __repr__(self):
+        return f'_Target(rule={self.rule!r}, outputs={self.outputs!r})'
+
+
 def _get_resource_file(filename, search_base_dir=None) -> PurePath:
     candidates = (Path(search_dir) / filename for search_dir in filter(None, (search_base_dir, *_RESOURCE_PATH)))
     with suppress(StopIteration):
@@ -51,6 +116,120 @@ def _get_resource_file(filename, search_base_dir=None) -> PurePath:
     raise FileNotFoundError(filename)
 
 
+def _ordered_set(iterable) -> AbstractSet:
+    ''' Set keeping the first-insertion order of `iterable`, so that generated files do not change from one run to another '''
+    return dict.fromkeys(iterable).keys()
+
+
+def _unique(items) -> tuple:
+    ''' Removes duplicates by identity, keeping the first occurrence order '''
+    return tuple({id(item): item for item in items}.values())
+
+
+def _unique_last(items) -> tuple:
+    ''' Removes duplicates by identity, keeping the last occurrence order '''
+    return _unique(reversed(tuple(items)))[::-1]
+
+
+def _group_by(items, key) -> Iterable:
+    ''' Groups `items` by `key`, in first occurrence order; unlike :func:`itertools.groupby`, `items` need not be sorted '''
+    groups = {}
+    for item in items:
+        groups.setdefault(key(item), []).append(item)
+    return groups.items()
+
+
+class _Tracer(object):
+    ''' Spans of a run, kept as Chrome trace events (see the "Trace Event Format" document of the Chromium project)
+
+        Spans nest within a thread, except the asynchronous ones (generated files, several of them being written at once).
+        Short and frequent operations are not recorded one by one but aggregated (see :meth:`add`).
+    '''
+
+    def __init__(self):
+        self.__events, self.__totals, self.__ids, self.__lock = [], {}, count(), Lock()
+
+    @contextmanager
+    def span(self, name, category):
+        start = perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.__events.append(dict(name=name, cat=category, ph='X', ts=start / 1000, dur=(perf_counter_ns() - start) / 1000, pid=getpid(), tid=get_ident()))
+
+    @contextmanager
+    def async_span(self, name, category):
+        event = dict(name=name, cat=category, id=next(self.__ids), pid=getpid(), tid=get_ident())
+        self.__events.append(dict(event, ph='b', ts=perf_counter_ns() / 1000))
+        try:
+            yield
+        finally:
+            self.__events.append(dict(event, ph='e', ts=perf_counter_ns() / 1000))
+
+    def add(self, name, category, duration_ns):
+        ''' Aggregates `duration_ns` to the total of `name` '''
+        with self.__lock:
+            calls, total = self.__totals.get((category, name), (0, 0))
+            self.__totals[(category, name)] = calls + 1, total + duration_ns
+
+    def take(self):
+        ''' Removes the recorded spans, to be :meth:`merge` into the tracer of another process '''
+        taken, self.__events, self.__totals = (self.__events, self.__totals), [], {}
+        return taken
+
+    def merge(self, taken):
+        events, totals = taken
+        self.__events.extend(events)
+        for (category, name), (calls, total) in totals.items():
+            with self.__lock:
+                previous_calls, previous_total = self.__totals.get((category, name), (0, 0))
+                self.__totals[(category, name)] = previous_calls + calls, previous_total + total
+
+    def summary(self) -> dict:
+        ''' Number of spans and seconds spent, by category and name (nested spans are counted in their parents too) '''
+        result, starts = {}, {}
+        def add(category, name, calls, duration_ns):
+            entry = result.setdefault(category, {}).setdefault(name, dict(count=0, seconds=0))
+            entry['count'] += calls
+            entry['seconds'] += duration_ns / 10 ** 9
+        for event in self.__events:
+            if event['ph'] == 'X':
+                add(event['cat'], event['name'], 1, event['dur'] * 1000)
+            elif event['ph'] == 'b':
+                starts[(event['pid'], event['id'])] = event['ts']
+            elif event['ph'] == 'e':
+                add(event['cat'], event['name'], 1, (event['ts'] - starts.pop((event['pid'], event['id']))) * 1000)
+        for (category, name), (calls, total) in self.__totals.items():
+            add(category, name, calls, total)
+        return result
+
+    def trace(self) -> dict:
+        ''' Chrome trace: recorded spans, then the aggregated ones as a global instant event per category '''
+        end = max((event['ts'] + event.get('dur', 0) for event in self.__events), default=0)
+        aggregates = _group_by(self.__totals.items(), key=lambda item: item[0][0])
+        return dict(displayTimeUnit='ms', traceEvents=[*self.__events, *(dict(name=category, cat=category, ph='i', s='g', ts=end, pid=getpid(), tid=get_ident(),
+                                                                              args={name: dict(count=calls, seconds=total / 10 ** 9) for (_, name), (calls, total) in items}) for category, items in aggregates)])
+
+
+_NO_SPAN = nullcontext()
+
+
+def _span(name, category):
+    ''' Span recorded by the tracer of the run, if any; nothing but this call otherwise '''
+    return _TRACER.span(name, category) if _TRACER else _NO_SPAN
+
+
+def _async_span(name, category):
+    return _TRACER.async_span(name, category) if _TRACER else _NO_SPAN
+
+
+def _memoized(memo, key, compute):
+    with suppress(KeyError):
+        return memo[key]
+    result = memo[key] = compute()
+    return result
+
+
 def _extract_globals(func, initial_globals=None, additional_entries=None) -> tuple:
     globals_ = initial_globals or globals().copy()
     initial_keys = frozenset(globals_.keys())
@@ -60,8 +239,55 @@ def _extract_globals(func, initial_globals=None, additional_entries=None) -> tup
     return namedtuple('globals_' + uuid4().hex, globals_.keys())(**globals_)
 
 
-@lru_cache(maxsize=None)
+def compile_cached(path) -> CodeType:
+    ''' Compiles the Python source file `path`, through a bytecode cache
+
+        The source is decoded with the locale encoding, as `open` reads it. The code is kept in memory while the file is unchanged and, if
+        :data:`_BYTECODE_DIR` is set, written there as a hash-based .pyc file (see PEP 552), not next to the source: it is used as long as
+        the content of the source, its encoding and the version of the interpreter are the same
+    '''
+    path = Path(path)
+    status = path.stat()
+    key = str(path), status.st_mtime_ns, status.st_size
+    code = _CODE_CACHE.get(key)
+    if code is None:
+        source, encoding = path.read_bytes(), getpreferredencoding(False)
+        header = MAGIC_NUMBER + (0b11).to_bytes(4, 'little') + source_hash(encoding.encode() + b'\0' + source)  # hash based, checked
+        cache = _bytecode_file(path)
+        with suppress(OSError, ValueError, EOFError, TypeError):
+            data = cache.read_bytes() if cache else b''
+            if data.startswith(header):
+                code = marshal.loads(memoryview(data)[len(header):])
+        if code is None:
+            code = compile(source.decode(encoding), str(path), 'exec', dont_inherit=True, optimize=0)
+            if cache and not sys.dont_write_bytecode:
+                with suppress(OSError):
+                    cache.parent.mkdir(parents=True, exist_ok=True)
+                    temporary = cache.with_name(f'.{cache.name}.{getpid()}.{get_ident()}.tmp')
+                    temporary.write_bytes(header + marshal.dumps(code))
+                    replace(temporary, cache)
+        _CODE_CACHE[key] = code
+    return code
+
+
+def _bytecode_file(path):
+    ''' .pyc file of `path` in :data:`_BYTECODE_DIR` (prjdefs share the same name: the path is hashed into it), None if not cached '''
+    tag = sys.implementation.cache_tag
+    if _BYTECODE_DIR is None or tag is None:
+        return None
+    return _BYTECODE_DIR / f'{path.name}.{sha256(str(path.resolve()).encode()).hexdigest()[:16]}.{tag}.pyc'
+
+
+_TOOLSET_LOCK = RLock()  # toolset modules load the toolsets they derive from
+
+
 def toolset_class(toolset, search_base_dir=Path.cwd()) -> type:
+    with _TOOLSET_LOCK:  # loaded once, even by prjdefs evaluated concurrently
+        return _toolset_class(toolset, search_base_dir)
+
+
+@lru_cache(maxsize=None)
+def _toolset_class(toolset, search_base_dir) -> type:
     filename, classname = (*toolset.split('.', 1), 'Toolset')[:2]
     filename = _get_resource_file(filename + '.py', search_base_dir=search_base_dir)
     module_ = SourceFileLoader(filename.stem, str(filename)).load_module()
@@ -69,22 +295,26 @@ def toolset_class(toolset, search_base_dir=Path.cwd()) -> type:
 
 
 class Env(object):
-    __stack = []
+    __stack = ContextVar('Env.stack', default=())  # environments being defined by the context (thread), innermost last
+    __EAGER_VIEWS = ('all_subenvs', 'local_subenvs', 'first_class_subenvs', 'parent_flags', 'local_flags', 'all_flavours', 'all_toolsets', 'dependencies', 'globs', 'all_defaults', 'all_injections', 'all_pools')
 
     @classmethod
     @contextmanager
     def _pushed(cls, env):  # pylint:disable=redefined-outer-name
         logging.debug(f'Push {env}')
-        cls.__stack.append(env)
-        yield env
-        cls.__stack.pop()
-        logging.debug('Pop')
+        token = cls.__stack.set((*cls.__stack.get(), env))
+        try:
+            yield env
+        finally:
+            cls.__stack.reset(token)
+            logging.debug('Pop')
 
     @classmethod
     def _head(cls):
-        return cls.__stack[-1] if cls.__stack else None
+        stack = cls.__stack.get()
+        return stack[-1] if stack else None
 
-    def __init__(self, prj_file, *, source_dir='.', build_dir='build', ninja_file='build.ninja', supenv=None):
+    def __init__(self, prj_file, *, source_dir='.', build_dir=_ENV_BUILD_DIR, ninja_file='build.ninja', supenv=None):
         '''
             args:
                 prj_file: project file
@@ -102,12 +332,15 @@ class Env(object):
         self.__subenvs = ()
         self.__defaults = ()
         self.__injections = {}
+        self.__pools = {}
 
-        self.__lineno = next((lineno for _, frame_filename, lineno, *_ in stack(context=0) if self.__prj_file.samefile(frame_filename)), 0)
+        self.__lineno = next((lineno for _, frame_filename, lineno, *_ in stack(context=0) if not frame_filename.startswith('<') and self.__prj_file.samefile(frame_filename)), 0)
         self.__dependencies = set()
+        self.__globs = set()
 
         self.__toolsets = ()
         self.__flavours = OrderedDict()
+        self.__views = None  # {name: value} once sealed
 
         with self._pushed(self):
             for toolset in self.all_toolsets:
@@ -116,6 +349,39 @@ class Env(object):
     def __str__(self):
         return f'{self.prj_file!s}:{self.__lineno}'
 
+    def seal(self):
+        ''' Freezes the environment and its sub environments, once parsed (see :func:`parse`)
+
+            Their views (`all_subenvs`, `local_flags`, `dependencies`...) are then computed once and stored, instead of being computed again
+            on each access; adding anything to a sealed environment raises RuntimeError
+            returns:
+                Env: self
+        '''
+        if self.__views is None:
+            for subenv in self.__subenvs:
+                subenv.seal()
+            self.__views = {}
+            for name in self.__EAGER_VIEWS:
+                getattr(self, name)
+        return self
+
+    @property
+    def sealed(self):
+        return self.__views is not None
+
+    def __view(self, name, compute):
+        ''' Result of `compute`, stored as `name` if the environment is sealed '''
+        if self.__views is None:
+            return compute()
+        try:
+            return self.__views[name]
+        except KeyError:
+            return self.__views.setdefault(name, compute())
+
+    def __check_unsealed(self):
+        if self.__views is not None:
+            raise RuntimeError(f'{self!s}: environment sealed, parsing is over')
+
     @property
     def prj_file(self):
         '''Absolute'''
@@ -150,11 +416,21 @@ class Env(object):
 
     @property
     def dependencies(self):
-        return frozenset(Path(dependency).resolve() for dependency in chain(self.__dependencies, *(env.dependencies for env in self.all_subenvs)))
+        return self.__view('dependencies', lambda: frozenset(chain(map(Path.resolve, map(Path, self.__dependencies)), *(env.dependencies for env in self.__subenvs))))
 
     def add_dependency(self, dependency):
+        self.__check_unsealed()
         self.__dependencies.add(dependency)
 
+    @property
+    def globs(self):
+        '''(root, pattern) of every :func:`Glob`, root is absolute'''
+        return self.__view('globs', lambda: frozenset(chain(self.__globs, *(env.globs for env in self.__subenvs))))
+
+    def add_glob(self, root, pattern):
+        self.__check_unsealed()
+        self.__globs.add((Path(root).resolve(), pattern))
+
     @property
     def supenv(self):
         return self.__supenv
@@ -163,20 +439,27 @@ class Env(object):
     def first_class_supenv(self):
         return self if self.ninja_file or not self.supenv else self.supenv.first_class_supenv 
 
+    @property
+    def subenvs(self) -> Iterator['Env']:
+        return self.__subenvs
+
     @property
     def all_subenvs(self) -> AbstractSet['Env']:
-        return frozenset(self.__subenvs).union(*(env.all_subenvs for env in self.__subenvs))
+        return self.__view('all_subenvs', lambda: _ordered_set(chain(self.__subenvs, *(env.all_subenvs for env in self.__subenvs))))
 
     @property
     def local_subenvs(self) -> AbstractSet['Env']:
-        local_subenvs = {env for env in self.__subenvs if not env.ninja_file}
-        return frozenset(local_subenvs).union(*(env.local_subenvs for env in local_subenvs))
+        def compute():
+            local_subenvs = _ordered_set(env for env in self.__subenvs if not env.ninja_file)
+            return _ordered_set(chain(local_subenvs, *(env.local_subenvs for env in local_subenvs)))
+        return self.__view('local_subenvs', compute)
 
     @property
     def first_class_subenvs(self) -> AbstractSet['Env']:
-        return frozenset(env for env in self.all_subenvs if env.ninja_file)
+        return self.__view('first_class_subenvs', lambda: _ordered_set(env for env in self.all_subenvs if env.ninja_file))
 
     def add_subenv(self, env):  # pylint:disable=redefined-outer-name
+        self.__check_unsealed()
         self.__subenvs += (env,)
         return env
 
@@ -186,13 +469,14 @@ class Env(object):
 
     @property
     def parent_flags(self) -> Iterator[_Variable]:
-        return (*(self.supenv.parent_flags if self.supenv else ()), *self.flags)
+        return self.__view('parent_flags', lambda: (*(self.supenv.parent_flags if self.supenv else ()), *self.flags))
 
     @property
     def local_flags(self) -> Iterator[_Variable]:
-        return (*(self.supenv.local_flags if self.supenv else ()), *(self.flags if not self.ninja_file else ()))
+        return self.__view('local_flags', lambda: (*(self.supenv.local_flags if self.supenv else ()), *(self.flags if not self.ninja_file else ())))
 
     def add_flag(self, flag: _Variable):
+        self.__check_unsealed()
         self.__flags += (flag,)
         return flag
 
@@ -201,56 +485,83 @@ class Env(object):
         return self.__targets.values()
 
     def add_target(self, target: _Target):
+        self.__check_unsealed()
         logging.debug('Add target %s', ','.join(map(str, target.outputs)))
-        target = target._replace(env=self)
-        self.__targets.update((output, target) for output in target.outputs)
+        target = target if target.env is self else target._replace(env=self)
+        self.__targets[target.outputs] = target
         return target
 
     @property
     def all_targets(self) -> AbstractSet[_Target]:
-        return frozenset(self.targets).union(*(env.targets for env in self.all_subenvs))
+        return self.__view('all_targets', lambda: _ordered_set(chain(self.targets, *(env.targets for env in self.all_subenvs))))
 
     @property
     def local_targets(self) -> AbstractSet[_Target]:
-        return frozenset(self.targets).union(*(env.targets for env in self.local_subenvs))
+        return self.__view('local_targets', lambda: _ordered_set(chain(self.targets, *(env.targets for env in self.local_subenvs))))
 
     @property
     def terminal_targets(self) -> AbstractSet[_Target]:
-        return self.local_targets.difference(*(chain(target.inputs, target.implicit_inputs) for target in self.local_targets))
+        def compute():
+            inputs = frozenset(chain.from_iterable(chain(target.inputs, target.implicit_inputs) for target in self.local_targets))
+            return _ordered_set(target for target in self.local_targets if target not in inputs)
+        return self.__view('terminal_targets', compute)
 
     @property
     def all_flavours(self):
-        return dict(chain(((flavour.name, flavour) for flavour in self.supenv.all_flavours) if self.supenv and not self.ninja_file else (), self.__flavours.items())).values() or (DEFAULT_FLAVOUR,)
-
-    def add_flavour(self, flavour: _Flavour):
+        return self.__view('all_flavours', lambda: dict(chain(((flavour.name, flavour) for flavour in self.supenv.all_flavours) if self.supenv and not self.ninja_file else (), self.__flavours.items())).values() or (DEFAULT_FLAVOUR,))
+
+    def add_flavour(self, flavour: _Flavour, *, replace=False):
+        self.__check_unsealed()
+        previous = self.__flavours.get(flavour.name)
+        if previous and not replace:  # declared again (by the compiler and the linker toolsets, by a prjdef adding flags to a flavour of its toolsets...)
+            # flags already declared are not repeated: toolsets applied on top of others (a bundle of extra flavours...) declare them again
+            flavour = flavour._replace(flags=(*previous.flags, *(flag for flag in flavour.flags if flag not in previous.flags)))
         self.__flavours[flavour.name] = flavour
         return flavour
 
     @property
     def all_toolsets(self):
-        return tuple(chain(self.__toolsets, self.supenv.all_toolsets if self.supenv and not self.ninja_file else _LOADED_TOOLSETS))
+        return self.__view('all_toolsets', lambda: tuple(chain(self.__toolsets, self.supenv.all_toolsets if self.supenv and not self.ninja_file else _LOADED_TOOLSETS)))
 
     def add_toolset(self, toolset):
+        self.__check_unsealed()
         logging.debug('Add toolset %s', type(toolset))
         self.__toolsets += (toolset,)
         return toolset
 
     @property
     def all_defaults(self):
-        return tuple(chain(self.__defaults, *(env.all_defaults for env in self.all_subenvs)))
+        return self.__view('all_defaults', lambda: _unique(chain(self.__defaults, *(env.all_defaults for env in self.__subenvs))))
 
     def add_default(self, default):
+        self.__check_unsealed()
         self.__defaults += (default,)
 
     @property
     def all_injections(self):
-        def injections_recursive(env):
-            return chain(env.__injections.items(), *(injections_recursive(subenv) for subenv in env.all_subenvs))
-        return tuple(dict(injections_recursive(self)).values())
+        return tuple(self.__all_injections().values())
+
+    def __all_injections(self):
+        ''' {key: injection} of the environment and its sub environments '''
+        return self.__view('injections', lambda: dict(chain(self.__injections.items(), *(env.__all_injections().items() for env in self.__subenvs))))
 
     def add_injection(self, injection, *, key=None):
+        self.__check_unsealed()
         self.__injections[key if key is not None else injection] = injection
 
+    @property
+    def all_pools(self):
+        return tuple(self.__all_pools().values())
+
+    def __all_pools(self):
+        ''' {name: pool} of the environment and its sub environments, which it overrides '''
+        return self.__view('pools', lambda: dict(chain(*(env.__all_pools().items() for env in self.__subenvs), self.__pools.items())))
+
+    def add_pool(self, pool: _Pool):
+        self.__check_unsealed()
+        self.__pools[pool.name] = pool
+        return pool
+
 
 
 class _EnvHead(object):
@@ -298,7 +609,7 @@ def Target(inputs: Iterable[Union[PurePath, _Target, _Filter]], outputs: Iterabl
         returns:
             Target
     '''
-    return E.add_target(_Target(None, tuple(inputs), tuple(implicit_inputs), tuple(order_only_inputs), rule, tuple(flags), tuple(outputs), tuple(implicit_outputs), tuple(output_flags)))
+    return E.add_target(_Target(E.actual, tuple(inputs), tuple(implicit_inputs), tuple(order_only_inputs), rule, tuple(flags), tuple(outputs), tuple(implicit_outputs), tuple(output_flags)))
 
 #   Target(outputs=(E.ninja_file,), rule='genjutsu', inputs=(E.prj_file,), variables=(Variable('GENJUTSU', sys.executable + ' ' + sys.argv[0]),))
 
@@ -315,17 +626,35 @@ def Alias(name, targets):  # pylint: disable=invalid-name
     return Target(targets, (name,), 'phony')
 
 
-def Flavour(name, flags):  # pylint: disable=invalid-name
+def Flavour(name, flags, *, replace=False):  # pylint: disable=invalid-name
     ''' Flavours are configurations
-        Express debug/release build configurations
+        Express debug/release build configurations; the flags of a flavour declared again in the same environment are added to its own
+        (but the ones it already has), unless `replace` is set
 
         args:
             name
             flags
+            replace: drop the flags of the flavour of the same name already declared in the environment (by its toolsets...)
         returns:
             Flavour
     '''
-    return E.add_flavour(_Flavour(name, flags=flags))
+    return E.add_flavour(_Flavour(name, flags=flags), replace=replace)
+
+
+def Pool(name, depth=None, *, job_memory=None):  # pylint: disable=invalid-name
+    ''' Declares a ninja pool, bounding the number of its targets built concurrently
+
+        args:
+            name: pool name, formatted with the flavour (`'link_{flavour}'` declares one pool per flavour, and one for the targets which do
+                  not depend on the flavour, `'link_default'`)
+            depth: number of concurrent jobs; if None, computed at generation from the number of CPUs and, if `job_memory` is set,
+                   from the physical memory (see :func:`_pool_depth`), then shared by the pools of the flavours
+            job_memory: memory needed by a job, in bytes
+        returns:
+            Variable: flag putting the targets it is added to in the pool
+    '''
+    E.add_pool(_Pool(name, depth, job_memory))
+    return Variable('pool', name)
 
 
 def Default(target):  # pylint: disable=invalid-name
@@ -361,47 +690,186 @@ def Toolset(toolset) -> tuple:  # pylint: disable=invalid-name
         returns:
             namedtuple: namespace of the toolset
     '''
-    instance = E.add_toolset(toolset_class(toolset, search_base_dir=E.base_dir)())
-    instance.apply_to_env()
-    for env_ in chain(E.all_subenvs):
-        with env(env_):
-            instance.apply_to_env()
-    return _extract_globals(instance.add_rules)
+    with _span(str(toolset), 'toolset'):
+        instance = E.add_toolset(toolset_class(toolset, search_base_dir=E.base_dir)())
+        _add_class_dependencies(E.actual, type(instance))
+        instance.apply_to_env()
+        for env_ in chain(E.all_subenvs):
+            with env(env_):
+                instance.apply_to_env()
+        return _extract_globals(instance.add_rules)
+
+
+def _track_file(filename):
+    tracking = _TRACKING.get()
+    if tracking and filename and not filename.startswith('<') and not filename.endswith('.pyc'):
+        tracking[-1].add_dependency(filename)
+
+
+def _audit_hook(event, args):
+    if not _TRACKING.get():
+        return
+    if event == 'exec':
+        _track_file(getattr(args[0], 'co_filename', None))
+    elif event == 'open':
+        path, mode, flags = args
+        if isinstance(path, (str, bytes, PathLike)) and not (frozenset(mode).intersection('wax+') if mode else flags & (O_WRONLY | O_RDWR)):
+            _track_file(fsdecode(path))
+
+
+def _tracking_import(name, globals_=None, locals_=None, fromlist=(), level=0, *, import_):
+    module = import_(name, globals_, locals_, fromlist, level)
+    if _TRACKING.get():
+        _track_file(getattr(module, '__file__', None))
+        if not fromlist and not level:
+            _track_file(getattr(sys.modules.get(name), '__file__', None))
+    return module
+
+
+def _tracking_open(file, mode='r', *args, open_, **kwargs):  # pylint: disable=redefined-builtin
+    if isinstance(file, (str, bytes, PathLike)) and not frozenset(mode).intersection('wax+'):
+        _track_file(fsdecode(file))
+    return open_(file, mode, *args, **kwargs)
+
+
+def _tracking_profiler(parent):
+    ''' Profiler recording the files of the code executed by the thread (by `exec` or the import of a module, not the functions called, as
+        the audit hook), chained to its `parent` profiler: below Python 3.8, there are no audit hooks
+    '''
+    def profiler(frame, event, arg):
+        if event == 'call' and frame.f_code.co_name == '<module>':
+            _track_file(frame.f_code.co_filename)
+        if parent:
+            parent(frame, event, arg)
+    profiler.tracking = True
+    return profiler
 
 
-@contextmanager
-def _add_dependencies(env):
-    parent_profiler = getprofile()
+@lru_cache(maxsize=None)
+def _install_audit_hook():
+    ''' Audit hooks cannot be removed: installed once and for all, a no-op unless a prjdef is being evaluated '''
+    sys.addaudithook(_audit_hook)
+
+
+_AUDITED = hasattr(sys, 'addaudithook')  # Python 3.8+
+_HOOKS_LOCK = Lock()
+_HOOKED = []  # builtins replaced while prjdefs are being evaluated: (module, name, original)
+_HOOKED_COUNT = 0  # prjdefs being evaluated
 
-    def profilefunc(frame, event, arg):
-        if event == 'call':
-            filename = frame.f_code.co_filename
-            if not filename.startswith('<'):
-                env.add_dependency(filename)
-        if parent_profiler:
-            parent_profiler(frame, event, arg)
-    setprofile(profilefunc)
 
+@contextmanager
+def _dependency_hooks():
+    ''' Installs the hooks recording the files the prjdefs depend on, until the last prjdef being evaluated (by any thread) is done
+
+        They only fire on imports, code execution and file opening, not on every Python call as a profiler would. `__import__` sees the
+        modules imported again, which are neither opened nor executed; below Python 3.8, `open` is replaced too (`pathlib` calls
+        `io.open`), the audit hook is not available.
+    '''
+    global _HOOKED_COUNT
+    with _HOOKS_LOCK:
+        if not _HOOKED_COUNT:
+            if _AUDITED:
+                _install_audit_hook()
+            replaced = ((builtins, '__import__', partial(_tracking_import, import_=builtins.__import__)),)
+            if not _AUDITED:
+                replaced += tuple((module_, 'open', partial(_tracking_open, open_=getattr(module_, 'open'))) for module_ in (builtins, io))
+            for module_, name, hook in replaced:
+                _HOOKED.append((module_, name, getattr(module_, name)))
+                setattr(module_, name, hook)
+        _HOOKED_COUNT += 1
     try:
         yield
     finally:
-        setprofile(parent_profiler)
+        with _HOOKS_LOCK:
+            _HOOKED_COUNT -= 1
+            if not _HOOKED_COUNT:
+                while _HOOKED:
+                    setattr(*_HOOKED.pop())
+
+
+@contextmanager
+def _add_dependencies(env):
+    ''' Records into `env` the files imported, executed or read until exit '''
+    parent_profiler = None if _AUDITED else sys.getprofile()
+    profiled = not _AUDITED and not getattr(parent_profiler, 'tracking', False)  # not already by an enclosing prjdef of the thread
+    with _dependency_hooks():
+        token = _TRACKING.set((*_TRACKING.get(), env))
+        if profiled:
+            sys.setprofile(_tracking_profiler(parent_profiler))
+        try:
+            yield
+        finally:
+            if profiled:
+                sys.setprofile(parent_profiler)
+            _TRACKING.reset(token)
+
+
+def _add_class_dependencies(env, cls):
+    ''' Records the files defining `cls` and its bases (loaded once per process, they are not seen by the hooks of later prjdefs) '''
+    for filename in filter(None, (getattr(sys.modules.get(base.__module__), '__file__', None) for base in cls.__mro__)):
+        env.add_dependency(filename)
 
 
-@lru_cache(maxsize=None)
 def _Prjdef(path, kwargs_) -> tuple:  # pylint: disable=invalid-name
+    ''' Namespace of the prjdef `path`, evaluated once per set of `kwargs_` (see :data:`_PRJDEFS`)
+
+        The first caller evaluates it, the concurrent ones (see :func:`Prjdefs`) wait for its result, unless that would close a cycle of
+        threads waiting for each other (see :data:`_EVALUATING`).
+    '''
+    key = path, kwargs_
+    with _PRJDEFS_LOCK:
+        future = _PRJDEFS.get(key)
+        evaluate = future is None
+        if evaluate:
+            future = _PRJDEFS[key] = Future()
+            _EVALUATING[key] = get_ident()
+        elif not future.done():
+            _wait_for(key)
+    if evaluate:
+        try:
+            future.set_result(_evaluate_prjdef(path, kwargs_))
+        except BaseException as error:
+            with _PRJDEFS_LOCK:
+                del _PRJDEFS[key]  # evaluated again by the next parse
+            future.set_exception(error)
+            raise
+        finally:
+            with _PRJDEFS_LOCK:
+                del _EVALUATING[key]
+    try:
+        return future.result()
+    finally:
+        _WAITING.pop(get_ident(), None)
+
+
+def _wait_for(key):
+    ''' Records that the current thread waits for the evaluation of `key`, called with :data:`_PRJDEFS_LOCK` held
+
+        raises:
+            RecursionError: the evaluation of `key` waits, directly or through other threads, for the current thread
+    '''
+    thread = _EVALUATING.get(key)
+    while thread is not None:
+        if thread == get_ident():
+            raise RecursionError(f'{key[0]!s} includes itself')
+        thread = _EVALUATING.get(_WAITING.get(thread))
+    _WAITING[get_ident()] = key
+
+
+def _evaluate_prjdef(path, kwargs_) -> tuple:
     logging.debug(f'Parse file {path!s}')
-    with Env._pushed(Env(prj_file=path, **dict(kwargs_))) as env_:
+    with _span(str(path), 'prjdef'), Env._pushed(Env(prj_file=path, **dict(kwargs_))) as env_, _add_dependencies(env_):
+        env_.add_dependency(__file__)
+        env_.add_dependency(path)  # whatever the hooks see of it: its code may come from the cache of compile_cached
         globals_ = {k: v for k, v in vars(sys.modules[__name__]).items() if not k.startswith('_')}
         globals_['__file__'] = globals_['__prjdef__'] = E.prj_file
         for toolset in E.all_toolsets:
-            toolset.add_rules(globals_)
-        with E.prj_file.open() as stream:
-            def exec_(globals_):
-                code = compile(stream.read(), stream.name, 'exec', optimize=0)
-                with _add_dependencies(env_):
-                    exec(code, globals_, globals_)
-            return _extract_globals(exec_, initial_globals=globals_, additional_entries={'E': env_})  # pylint: disable=exec-used
+            _add_class_dependencies(env_, type(toolset))
+            with _span(f'{type(toolset).__module__}.{type(toolset).__qualname__}', 'toolset'):
+                toolset.add_rules(globals_)
+        def exec_(globals_):
+            exec(compile_cached(E.prj_file), globals_, globals_)  # pylint: disable=exec-used
+        return _extract_globals(exec_, initial_globals=globals_, additional_entries={'E': env_})
 
 
 def Prjdef(path, **kwargs) -> tuple:  # pylint: disable=invalid-name
@@ -414,13 +882,193 @@ def Prjdef(path, **kwargs) -> tuple:  # pylint: disable=invalid-name
         returns:
             namedtuple: namespace of the toolset
     '''
-    path = E.base_dir / path
-    path = path / 'prjdef' if path.is_dir() else path
-    prjdef = _Prjdef(path.resolve(), frozenset(kwargs.items()))
+    prjdef = _Prjdef(*_prjdef_key(path, kwargs))
     E.add_subenv(prjdef.E)
     return prjdef
 
 
+def Prjdefs(paths, **kwargs) -> tuple:  # pylint: disable=invalid-name
+    ''' Include other projects, as :func:`Prjdef`, evaluated concurrently by a pool of threads
+
+        Each prjdef is evaluated once, even if several of them include it. Their environments are added in the order of `paths`.
+        args:
+            paths: paths to prjdef files or directories containing a `prjdef` file
+            kwargs: forwarded to the constructor of Env of each of them
+
+        returns:
+            tuple: namespaces of the prjdefs
+    '''
+    keys = [_prjdef_key(path, kwargs) for path in paths]
+    futures = [_prjdef_executor().submit(copy_context().run, _Prjdef, *key) for key in keys[1:]]
+    prjdefs = [_Prjdef(*key) for key in keys[:1]]
+    for key, future in zip(keys[1:], futures):
+        future.cancel()  # not started yet: evaluated here rather than waiting for a busy worker, otherwise waited for by _Prjdef
+        prjdefs.append(_Prjdef(*key))
+    for prjdef in prjdefs:
+        E.add_subenv(prjdef.E)
+    return tuple(prjdefs)
+
+
+def _prjdef_key(path, kwargs) -> tuple:
+    path = E.base_dir / path
+    path = path / 'prjdef' if path.is_dir() else path
+    return path.resolve(), frozenset(kwargs.items())
+
+
+def _prjdef_executor():
+    ''' Thread pool of :func:`Prjdefs`, started by its first call during a parse and shut down at the end of the parse '''
+    global _PRJDEF_EXECUTOR
+    with _PRJDEFS_LOCK:
+        if _PRJDEF_EXECUTOR is None:
+            _PRJDEF_EXECUTOR = ThreadPoolExecutor(thread_name_prefix='prjdef')
+        return _PRJDEF_EXECUTOR
+
+
+def _shutdown_prjdef_executor():
+    ''' Waits for the threads of :func:`_prjdef_executor` to exit: no thread is left running once parsed (see :func:`_executor`) '''
+    global _PRJDEF_EXECUTOR
+    with _PRJDEFS_LOCK:
+        executor, _PRJDEF_EXECUTOR = _PRJDEF_EXECUTOR, None
+    if executor is not None:
+        executor.shutdown(wait=True)
+
+
+class _DirectoryIndex(object):
+    ''' Entries of the directories walked by :func:`Glob`: each directory is scanned once, whatever the number of patterns walking it
+
+        Directories scanned by a previous run (see :meth:`new_run`), possibly of a previous process (see :meth:`load`), are not scanned
+        again while their mtime is unchanged. :meth:`glob` matches the same paths, in the same order, as :meth:`pathlib.Path.glob`.
+    '''
+    _BROKEN_LINK, _FILE, _LINK_TO_DIRECTORY, _DIRECTORY = range(4)
+    _RACY_NS = 2 * 10 ** 9  # directories modified that close to their scan may have changed again within the resolution of their mtime
+
+    def __init__(self):
+        self.__directories = {}  # directory: (mtime_ns, scan time ns, {name: kind} in scandir order), mtime_ns is None if not a directory
+        self.__verified = set()
+        self.__scanning = {}  # directory: Future of its entries, while checked or scanned
+        self.__lock = Lock()  # prjdefs may glob concurrently (see :func:`Prjdefs`)
+
+    def new_run(self):
+        ''' Directories may have changed since the previous run: their mtime is checked again when they are first walked '''
+        self.__verified.clear()
+
+    def load(self, index_file):
+        ''' Restores the directories saved by :meth:`save`, to be checked before use '''
+        with suppress(OSError, ValueError, TypeError):
+            self.__directories.update((directory, (mtime, scanned, None if entries is None else dict(entries))) for directory, (mtime, scanned, entries) in json.loads(index_file.read_text()).items())
+        self.new_run()
+
+    def save(self, index_file):
+        ''' Saves the directories walked during the current run '''
+        with suppress(OSError), _StreamedFile(index_file) as stream:
+            json.dump({directory: (mtime, scanned, None if entries is None else tuple(entries.items())) for directory, (mtime, scanned, entries) in self.__directories.items() if directory in self.__verified}, stream)
+
+    def glob(self, root, pattern) -> Iterator[str]:
+        ''' Paths matching `pattern`, relative to `root`, as `Path(root).glob(pattern)` would match them
+            Paths are not built here: the ones of most directory entries would just be compared, hashed or converted back to strings
+        '''
+        root, pattern_path = str(root), PurePath(pattern)
+        if pattern_path.anchor:
+            raise NotImplementedError('Non-relative patterns are unsupported')
+        if not pattern_path.parts:
+            raise ValueError(f'Unacceptable pattern: {pattern!r}')
+        parts = pattern_path.parts + (('',) if pattern[-1] in (sep, altsep) else ())
+        if self.__entries(root) is not None:
+            yield from self.__select(root, '', parts)
+
+    def __entries(self, directory):
+        ''' returns: dict: kind of the entries of `directory` by name, None if it is not a directory
+
+            The lock only guards the bookkeeping: directories are checked and scanned outside of it, concurrently with the other ones,
+            threads walking a directory being scanned waiting for its scan
+        '''
+        with self.__lock:
+            scanning = self.__scanning.get(directory)
+            if scanning is None:
+                if directory in self.__verified:
+                    return self.__directories[directory][2]
+                self.__verified.add(directory)
+                self.__scanning[directory] = future = Future()
+                cached = self.__directories.get(directory)
+        if scanning is not None:
+            return scanning.result()
+        try:
+            try:
+                status = stat(directory)
+                mtime = status.st_mtime_ns if S_ISDIR(status.st_mode) else None
+            except OSError:
+                mtime = None
+            if not cached or cached[0] != mtime or mtime is not None and cached[1] - mtime < self._RACY_NS:
+                scanned = time_ns()
+                cached = (mtime, scanned, self.__scan(directory) if mtime is not None else None)
+        except BaseException as error:
+            with self.__lock:
+                self.__verified.discard(directory)
+                del self.__scanning[directory]
+            future.set_exception(error)
+            raise
+        with self.__lock:
+            self.__directories[directory] = cached
+            del self.__scanning[directory]
+        future.set_result(cached[2])
+        return cached[2]
+
+    def __scan(self, directory):
+        def kind(entry):
+            with suppress(OSError):
+                if entry.is_dir(follow_symlinks=False):
+                    return self._DIRECTORY
+                if entry.is_dir():
+                    return self._LINK_TO_DIRECTORY
+                return self._BROKEN_LINK if entry.is_symlink() and not exists(entry.path) else self._FILE
+            return self._FILE
+        try:
+            with scandir(directory) as entries:
+                return {entry.name: kind(entry) for entry in entries}
+        except OSError:
+            return {}
+
+    def __select(self, root, path, parts):
+        if not parts or not parts[0]:
+            yield path
+            return
+        part, child_parts = parts[0], parts[1:]
+        entries = self.__entries(join(root, path) if path else root) or {}
+        if part == '**':
+            yielded = set()
+            for directory in self.__walk(root, path):
+                for match in self.__select(root, directory, child_parts):
+                    if match not in yielded:
+                        yielded.add(match)
+                        yield match
+        elif '**' in part:
+            raise ValueError("Invalid pattern: '**' can only be an entire path component")
+        elif re.search('[*?[]', part):
+            match = _compile_name_pattern(part)
+            for name, kind in entries.items():
+                if (kind > self._FILE or not child_parts) and match(name):
+                    yield from self.__select(root, join(path, name), child_parts)
+        else:
+            kind = entries.get(part, self._BROKEN_LINK)  # unknown names (such as '..', or another case of a name) are checked as broken links
+            child = join(path, part)
+            if kind > self._FILE or kind == self._FILE and not child_parts or kind == self._BROKEN_LINK and (isdir if child_parts else exists)(join(root, child)):
+                yield from self.__select(root, child, child_parts)
+
+    def __walk(self, root, directory):
+        yield directory
+        for name, kind in (self.__entries(join(root, directory) if directory else root) or {}).items():
+            if kind == self._DIRECTORY:
+                yield from self.__walk(root, join(directory, name))
+
+
+@lru_cache(maxsize=None)
+def _compile_name_pattern(pattern):
+    return re.compile(translate(pattern), re.IGNORECASE if os_name == 'nt' else 0).fullmatch
+
+
+_DIRECTORY_INDEX = _DirectoryIndex()
+
+
 def Glob(pattern, *, root=None) -> Iterator[PurePath]:  # pylint: disable=invalid-name
     ''' Just like glob module
 
@@ -432,8 +1080,9 @@ def Glob(pattern, *, root=None) -> Iterator[PurePath]:  # pylint: disable=invali
             Path: matching file
     '''
     root = root or E.get_source_path()
-    for k in root.glob(pattern):
-        yield k.relative_to(root)
+    E.add_glob(root, pattern)
+    for k in _DIRECTORY_INDEX.glob(root, pattern):
+        yield Path(k)
 
 
 def Filter(inputs, function):  # pylint: disable=invalid-name
@@ -477,36 +1126,134 @@ def resolve(value, *, env=None, flavour=None, quote_paths=False):
         yield value
 
 
+
+class _Resolver(object):
+    ''' :func:`resolve_escape_join` and :func:`resolve_escape_join_flag` for an environment and a flavour, over whole lists of values
+
+        Paths are resolved, escaped and quoted once per environment: targets share most of their inputs, and the outputs of a target are
+        written again as inputs, phony targets and defaults. Strings, most often flags merged per target, are not cached but neither parsed
+        nor formatted unless they hold a `{flavour}` field. Lists and targets are walked without generators, anything else is left to
+        :func:`resolve`.
+    '''
+
+    def __init__(self, env, flavour):  # pylint:disable=redefined-outer-name
+        self.__env, self.__flavour = env, flavour
+        self.__items = {False: {}, True: {}}  # quoted paths: {(environment, path): resolved item}
+
+    def join(self, value) -> str:
+        items = []
+        self.__resolve(value, self.__env, False, items)
+        return ' '.join(items)
+
+    def join_flag(self, value) -> str:
+        items = []
+        self.__resolve(value, self.__env, True, items)
+        return ''.join(items)
+
+    def __resolve(self, value, env, quote_paths, items):  # pylint:disable=redefined-outer-name
+        if isinstance(value, str):
+            items.append(self.__item(value, env, quote_paths))
+        elif isinstance(value, PurePath):
+            cache, key = self.__items[quote_paths], (env, value)
+            item = cache.get(key)
+            if item is None:
+                if len(cache) >= _RESOLVED_PATHS:
+                    cache.clear()
+                item = cache[key] = self.__item(value, env, quote_paths)
+            items.append(item)
+        elif hasattr(value, 'outputs'):
+            self.__resolve(value.outputs, getattr(value, 'env', env), quote_paths, items)
+        elif isinstance(value, (tuple, list)) and not isinstance(value, _Flavour):
+            for item in value:
+                self.__resolve(item, env, quote_paths, items)
+        else:
+            items.extend(map(str if quote_paths else escape, resolve(value, env=env, flavour=self.__flavour, quote_paths=quote_paths)))
+
+    def __item(self, value, env, quote_paths) -> str:  # pylint:disable=redefined-outer-name
+        ''' The item :func:`resolve` yields for a path or a string, without parsing paths again when they are not formatted '''
+        is_path = isinstance(value, PurePath)
+        item = str(env.base_dir / value if is_path and env else value)
+        if self.__flavour is not None and ('{' in item or '}' in item):
+            item = item.format(flavour=self.__flavour.name)
+            item = str(PurePath(item)) if is_path else item
+        return (f'"{item}"' if is_path else item) if quote_paths else escape(item)
+
+
+def _resolver(memo, env, flavour) -> _Resolver:  # pylint:disable=redefined-outer-name
+    ''' :class:`_Resolver` of `env` and `flavour`, memoized in `memo` '''
+    return _memoized(memo, ('resolver', id(env), flavour.name), lambda: _Resolver(env, flavour))
+
+
 def parse(path):
+    _PRJDEFS.clear()  # prjdefs may have changed since a previous parse in the same process
+    return _parse(path)
+
+
+def _parse(path):
+    ''' :func:`parse`, reusing the prjdefs left in :data:`_PRJDEFS` '''
     # load toolsets now that every symbol they might need to import from the current module is defined
     global _LOADED_TOOLSETS
     if not _LOADED_TOOLSETS:
-        _LOADED_TOOLSETS = tuple(toolset_class(toolset)() for toolset in _TOOLSETS)
+        with _span('load', 'toolset'):
+            _LOADED_TOOLSETS = tuple(toolset_class(toolset)() for toolset in _TOOLSETS)
 
     path = path / 'prjdef' if path.is_dir() else path
-    return _Prjdef(path.resolve(), frozenset())
+    _DIRECTORY_INDEX.new_run()
+    try:
+        prjdef = _Prjdef(path.resolve(), frozenset())
+    finally:
+        _shutdown_prjdef_executor()
+    prjdef.E.seal()
+    return prjdef
 
 def escape(value):
     return str(value).replace('$ ', '$$ ').replace(' ', '$ ').replace(':', '$:')
     
 def resolve_escape_join(value, *, env, flavour):
-    return ' '.join(escape(item) for item in resolve(value, env=env, flavour=flavour))
+    return _Resolver(env, flavour).join(value)
 
 def resolve_escape_join_flag(value, *, env, flavour):
-    return ''.join(str(item) for item in resolve(value, env=env, flavour=flavour, quote_paths=True))
+    return _Resolver(env, flavour).join_flag(value)
 
 def merge_flags(flag0, flag):
     return flag._replace(value=(flag0.value, flag.value)) if flag0.value and flag.append else flag
 
 def merge_flags_iterable(flags):
-    return sorted(reduce(lambda flags_dict, flag: dict(chain(flags_dict.items(), ((flag.name, merge_flags(flags_dict.get(flag.name, Variable(flag.name, ())), flag)),))), flags, {}).values())
+    ''' Merges flags by name, as :func:`merge_flags` would, sorted by name
 
-def get_target_flags(target, flavour):
-    def resolve_flags(flags, target=target):
-        return (flag._replace(value=resolve_escape_join_flag(flag.value, env=target.env, flavour=flavour)) for flag in flags)
-    def inputs_flags(target):
-        return chain(resolve_flags(target.output_flags, target), chain.from_iterable(inputs_flags(input_) for input_ in chain(target.inputs, target.implicit_inputs) if isinstance(input_, _Target)))
-    return merge_flags_iterable(chain(resolve_flags(target.env.local_flags), inputs_flags(target), resolve_flags(target.flags)))
+        The values of a name are appended to a list, flattened once at the end: merging is linear in the number of flags
+    '''
+    merged = {}
+    for flag in flags:
+        values = merged.get(flag.name, (None, ()))[1]
+        if flag.append and values and (len(values) > 1 or values[0]):
+            values.append(flag.value)
+        else:
+            values = [flag.value]
+        merged[flag.name] = flag, values
+    return sorted(flag._replace(value=values[0] if len(values) == 1 else tuple(values)) for flag, values in merged.values())
+
+def get_target_flags(target, flavour, *, memo=None):
+    ''' Flags of a target: local flags of its environment, then `output_flags` of the targets upstream, then its own `flags`
+
+        The `output_flags` of an upstream target are taken once, even if it is reached through several paths, where it is last reached in
+        depth-first pre-order: after the targets depending on it, as static libraries are linked
+        args:
+            memo: dictionary reused between calls sharing the same targets (see :meth:`_Graph.target_flags`), in which the flags of
+                  the upstream targets are memoized per (target, flavour); the cost of the resolution then grows with the number of edges
+    '''
+    memo = {} if memo is None else memo
+    def resolve_flags(flags, env):  # pylint:disable=redefined-outer-name
+        resolver = _resolver(memo, env, flavour)
+        return tuple(flag._replace(value=resolver.join_flag(flag.value)) for flag in flags)
+    def upstream(target):
+        ''' Upstream targets having `output_flags`, in depth-first pre-order, at their last occurrence '''
+        inputs = (input_ for input_ in chain(target.inputs, target.implicit_inputs) if isinstance(input_, _Target))
+        return _memoized(memo, ('upstream', id(target)), lambda: _unique_last(chain((target,) if target.output_flags else (), *map(upstream, inputs))))
+    def output_flags(target):
+        return _memoized(memo, ('output_flags', id(target), flavour.name), lambda: resolve_flags(target.output_flags, target.env))
+    local_flags = _memoized(memo, ('local_flags', id(target.env), flavour.name), lambda: resolve_flags(target.env.local_flags, target.env))
+    return merge_flags_iterable(chain(local_flags, chain.from_iterable(map(output_flags, upstream(target))), resolve_flags(target.flags, target.env)))
 
 def get_env_flags(env, flavour):
     def resolve_flags(flags):
@@ -514,23 +1261,334 @@ def get_env_flags(env, flavour):
     return merge_flags_iterable(chain(resolve_flags(env.parent_flags), resolve_flags(flavour.flags)))
 
 
-def _generate_env(env):  # pylint:disable=redefined-outer-name
-            
-    def phony_inputs(targets):
-        return reduce(frozenset.union, (phony_inputs(target.inputs) if target.rule == 'phony' else frozenset((target,)) for target in targets), frozenset())
+class _Graph(object):
+    ''' Compiled view of the targets of an :class:`Env` tree, built once after :func:`parse`
 
+        Targets are indexed in declaration order and looked up by identity (hashing a `_Target` hashes its whole upstream graph).
+        Inputs (explicit and implicit) are adjacency lists of indices, so that terminal targets and phony closures are linear to compute.
+        Sub environments and target memberships are computed once per environment.
+    '''
+
+    def __init__(self, env):  # pylint:disable=redefined-outer-name
+        self.__targets, self.__index, self.__own_targets = [], {}, {}
+        for env_ in (*self.__subenvs_post_order(env), env):
+            self.__own_targets[env_] = _unique(self.__add_target(target) for target in env_.targets)
+        self.__inputs = tuple(tuple(self.__index[id(input_)] for input_ in chain(target.inputs, target.implicit_inputs) if id(input_) in self.__index) for target in self.__targets)
+
+        self.__all_subenvs, self.__local_subenvs = {}, {}
+        for env_ in self.__own_targets:
+            local_subenvs = tuple(subenv for subenv in env_.subenvs if not subenv.ninja_file)
+            self.__all_subenvs[env_] = _unique(chain(env_.subenvs, *(self.__all_subenvs[subenv] for subenv in env_.subenvs)))
+            self.__local_subenvs[env_] = _unique(chain(local_subenvs, *(self.__local_subenvs[subenv] for subenv in local_subenvs)))
+        self.__memberships, self.__phony_closures, self.__flags = {}, {}, {}
+
+    @staticmethod
+    def __subenvs_post_order(env):  # pylint:disable=redefined-outer-name
+        return _unique(chain.from_iterable(chain(_Graph.__subenvs_post_order(subenv), (subenv,)) for subenv in env.subenvs))
+
+    def __add_target(self, target):
+        if id(target) not in self.__index:
+            self.__index[id(target)] = len(self.__targets)
+            self.__targets.append(target)
+        return self.__index[id(target)]
+
+    def __membership(self, key, env, compute):  # pylint:disable=redefined-outer-name
+        return _memoized(self.__memberships, (key, env), compute)
+
+    def __target_indices(self, key, env, subenvs):  # pylint:disable=redefined-outer-name
+        return self.__membership(key, env, lambda: _unique(chain(self.__own_targets[env], *(self.__own_targets[subenv] for subenv in subenvs))))
+
+    def all_subenvs(self, env) -> tuple:  # pylint:disable=redefined-outer-name
+        return self.__all_subenvs[env]
+
+    def local_subenvs(self, env) -> tuple:  # pylint:disable=redefined-outer-name
+        return self.__local_subenvs[env]
+
+    def first_class_subenvs(self, env) -> tuple:  # pylint:disable=redefined-outer-name
+        return self.__membership('first_class_subenvs', env, lambda: tuple(subenv for subenv in self.__all_subenvs[env] if subenv.ninja_file))
+
+    def all_targets(self, env) -> tuple:  # pylint:disable=redefined-outer-name
+        return self.__membership('all_targets', env, lambda: tuple(map(self.__targets.__getitem__, self.__target_indices('all_indices', env, self.__all_subenvs[env]))))
+
+    def local_targets(self, env) -> tuple:  # pylint:disable=redefined-outer-name
+        return self.__membership('local_targets', env, lambda: tuple(map(self.__targets.__getitem__, self.__target_indices('local_indices', env, self.__local_subenvs[env]))))
+
+    def terminal_targets(self, env) -> tuple:  # pylint:disable=redefined-outer-name
+        ''' Local targets which are not an input of another local target '''
+        def compute():
+            local_targets = self.__target_indices('local_indices', env, self.__local_subenvs[env])
+            inputs = frozenset(chain.from_iterable(map(self.__inputs.__getitem__, local_targets)))
+            return tuple(self.__targets[index] for index in local_targets if index not in inputs)
+        return self.__membership('terminal_targets', env, compute)
+
+    def phony_targets(self, env) -> tuple:  # pylint:disable=redefined-outer-name
+        return self.__membership('phony_targets', env, lambda: tuple(target for target in self.all_targets(env) if target.rule == 'phony'))
+
+    def target_flags(self, target, flavour):
+        ''' :func:`get_target_flags`, memoized for the lifetime of the graph; timings are aggregated per environment when traced '''
+        if not _TRACER:
+            return get_target_flags(target, flavour, memo=self.__flags)
+        start = perf_counter_ns()
+        try:
+            return get_target_flags(target, flavour, memo=self.__flags)
+        finally:
+            _TRACER.add(str(target.env.base_dir), 'flags', perf_counter_ns() - start)
+
+    def local_flags(self, env, flavour) -> list:  # pylint:disable=redefined-outer-name
+        ''' Local flags of `env`, resolved and merged as at the beginning of the flags of its targets (see :meth:`target_flags`) '''
+        def compute():
+            resolver = _resolver(self.__flags, env, flavour)
+            return merge_flags_iterable(flag._replace(value=resolver.join_flag(flag.value)) for flag in env.local_flags)
+        return _memoized(self.__flags, ('merged_local_flags', id(env), flavour.name), compute)
+
+    def phony_inputs(self, targets) -> tuple:
+        ''' Replaces the phony targets among `targets` by the non-phony targets they (transitively) reference '''
+        return _unique(chain.from_iterable(self.__phony_closure(target) if getattr(target, 'rule', None) == 'phony' else (target,) for target in targets))
+
+    def __phony_closure(self, target):
+        return _memoized(self.__phony_closures, id(target), lambda: self.phony_inputs(target.inputs))
+
+
+def compile_graph(env) -> _Graph:  # pylint:disable=redefined-outer-name
+    ''' Compiles the targets of `env` and of its sub environments into an indexed graph
+        To be called once parsing is complete: `env` is sealed (see :meth:`Env.seal`) if it is not already
+    '''
+    return _Graph(env.seal())
+
+
+def _flag_values(flag) -> tuple:
+    ''' Values of a flag merged by :func:`merge_flags_iterable` '''
+    return flag.value if isinstance(flag.value, tuple) else (flag.value,)
+
+
+def _hoist_flag_value(flag, variable, values):
+    ''' Value of `flag`, starting with a reference to `variable` instead of `values` if its values start with `values`
+
+        Variables are expanded as they are written, without escaping again: the resolved command lines are the same
+    '''
+    flag_values = _flag_values(flag)
+    return (f'${variable}', *flag_values[len(values):]) if values and flag_values[:len(values)] == values else flag.value
+
+
+def _injected_lines(env, flavours) -> tuple:  # pylint:disable=redefined-outer-name
+    ''' Lines starting the main build file (for all the flavours) and the build file of each flavour of `env`: rules and file scope variables '''
+    injected = _ordered_set(chain.from_iterable(injection(env, flavour).splitlines() for injection in env.all_injections for flavour in flavours))
+    return (f'include {escape(_get_resource_file("common.ninja_inc"))}', f'PYTHON={escape(sys.executable)}', *injected)
+
+
+@lru_cache(maxsize=None)
+def _machine_resources() -> tuple:
+    ''' returns:
+            tuple: number of CPUs available to the process, physical memory in bytes (None where not known)
+    '''
+    cpus = len(sched_getaffinity(0)) if sched_getaffinity else cpu_count() or 1
+    if sysconf:
+        with suppress(ValueError, OSError):
+            return cpus, sysconf('SC_PAGE_SIZE') * sysconf('SC_PHYS_PAGES')
+    return cpus, None
+
+
+def _pool_depth(pool) -> int:
+    ''' Depth of `pool`: its own, or one job per CPU, within the physical memory if the memory of its jobs is known '''
+    if pool.depth is not None:
+        return pool.depth
+    cpus, memory = _machine_resources()
+    return max(1, min(cpus, memory // pool.job_memory)) if pool.job_memory and memory else cpus
+
+
+def _pool_lines(env, flavours) -> Iterator[str]:  # pylint:disable=redefined-outer-name
+    ''' Declarations of the pools of `env` and of its sub environments, for `flavours`
+
+        A pool formatted with the flavour is declared once per flavour, and once for the default flavour: the targets which do not depend
+        on the flavour, written to the common build files, resolve its name with it. If its depth is computed, the pools of every flavour
+        of `env` share it, whichever file declares them: the build file of a flavour gives its pool the depth the root build file gives it,
+        so that building every flavour at once, from the root build file or from the ones of the flavours, does not run more jobs than the
+        machine holds
+    '''
+    depths = {}
+    for pool in env.all_pools:
+        names = {flavour.name: next(resolve(pool.name, flavour=flavour)) for flavour in (*env.all_flavours, DEFAULT_FLAVOUR)}
+        depth = _pool_depth(pool) if pool.depth is not None else max(1, _pool_depth(pool) // len(set(names.values())))
+        depths.update((names[flavour.name], depth) for flavour in (*flavours, DEFAULT_FLAVOUR))
+    return chain.from_iterable((f'pool {name}', f'  depth={depth}') for name, depth in depths.items())
+
+
+def _env_flag_lines(env, flavour) -> Iterator[str]:  # pylint:disable=redefined-outer-name
+    ''' Lines starting the local build file of a flavour of `env`: its flags, as file scope variables '''
+    resolve_escape_join_ = _Resolver(env, flavour).join
+    return (_flag_line(flag, flag.value, resolve_escape_join_) for flag in get_env_flags(env, flavour))
+
+
+def _flag_line(flag, value, resolve_escape_join_) -> str:
+    return f'{flag.name}={resolve_escape_join_((f"${flag.name}", value) if flag.append else value)}'
+
+
+_NINJA_ESCAPE = re.compile(r'\$(?:([$: ])|\n *|\{([\w.-]+)\}|([\w-]+))')
+_SHELL_SAFE = re.compile(r'[\w+./-]*', re.ASCII)  # characters of the paths ninja does not quote in $in and $out
+
+
+class _NinjaScope(object):
+    ''' Variables and rules of a ninja file, evaluated as ninja does (https://ninja-build.org/manual.html#ref_scope)
+
+        Variables, rules and includes are evaluated line by line, other statements are skipped. Sub ninja files are child scopes.
+    '''
+
+    def __init__(self, lines=(), parent=None):
+        self.__parent, self.__variables, self.__rules = parent, {}, {}
+        self.__read(lines)
+
+    def __read(self, lines):
+        rule = None
+        for line in _ninja_lines(lines):
+            statement = line.lstrip(' ')
+            if not statement or statement.startswith('#'):
+                continue
+            if statement is not line:  # binding of the preceding statement
+                if rule is not None:
+                    name, _, value = statement.partition('=')
+                    rule[name.strip()] = value.lstrip(' ')
+                continue
+            keyword, _, rest = statement.partition(' ')
+            rule = None
+            if keyword == 'rule':
+                rule = self.__rules[rest.strip()] = {}
+            elif keyword == 'include':
+                path = self.expand(rest.strip())
+                self.__read(_read_ninja_file(path, _signature(path)))
+            elif keyword not in ('build', 'default', 'pool', 'subninja'):
+                name, _, value = statement.partition('=')
+                self.__variables[name.strip()] = self.expand(value.lstrip(' '))
+
+    def lookup(self, name) -> str:
+        if name in self.__variables:
+            return self.__variables[name]
+        return self.__parent.lookup(name) if self.__parent else ''
+
+    def rule(self, name) -> dict:
+        if name in self.__rules:
+            return self.__rules[name]
+        if self.__parent is None:
+            raise KeyError(f'unknown rule {name}')
+        return self.__parent.rule(name)
+
+    def expand(self, value, lookup=None) -> str:
+        lookup = lookup or self.lookup
+        def replace(match):
+            escaped, name = match.group(1), match.group(2) or match.group(3)
+            return escaped or (lookup(name) if name else '')
+        return _NINJA_ESCAPE.sub(replace, value)
+
+    def command(self, rule, bindings, inputs, outputs) -> str:
+        ''' Command of a build statement of this scope
+
+            args:
+                bindings: (unevaluated) lines binding the variables of the statement
+                inputs, outputs: explicit ones, unescaped
+        '''
+        rule = self.rule(rule)
+        edge = {name.strip(): self.expand(value.lstrip(' ')) for name, _, value in (binding.partition('=') for binding in bindings)}
+        edge.update({'in': ' '.join(map(_shell_escape, inputs)), 'out': ' '.join(map(_shell_escape, outputs))})
+        def lookup(name):
+            if name in edge:
+                return edge[name]
+            return self.expand(rule[name], lookup) if name in rule else self.lookup(name)
+        return self.expand(rule['command'], lookup)
+
+
+def _ninja_lines(lines) -> Iterator[str]:
+    ''' Joins the lines ending with an (unescaped) $ with the next one, without its indentation '''
+    continued = None
+    for line in lines:
+        line = line if continued is None else continued + line.lstrip(' ')
+        continued = line[:-1] if (len(line) - len(line.rstrip('$'))) % 2 else None
+        if continued is None:
+            yield line
+
+
+@lru_cache(maxsize=None)
+def _read_ninja_file(path, signature) -> tuple:  # pylint:disable=unused-argument
+    ''' Lines of an included ninja file, read again when its `signature` (see :func:`_signature`) changes
+
+        Ninja reads bytes: bytes which do not decode (`mscl.ninja_inc` is not UTF-8) are kept as surrogates instead of failing
+    '''
+    return tuple(Path(path).read_text(errors='surrogateescape').splitlines())
+
+
+def _shell_escape(path) -> str:
+    ''' `path` as ninja writes it in $in and $out '''
+    if os_name == 'nt':
+        return f'"{path}"' if ' ' in path or '"' in path else path
+    return path if _SHELL_SAFE.fullmatch(path) else "'" + path.replace("'", "'\\''") + "'"
+
+
+def _write_compdb(stream, root, envs, graph, flavour_name):
+    ''' Writes the compilation database of a flavour, as `ninja -t compdb` run on the build file of the flavour of `root` lists it
+
+        Commands are evaluated in the scopes of the files their targets are written to (see :func:`_generate_env_files`), without their
+        COMPILER_LAUNCHER (see `CompilerLauncher`): tools take the first word of a command for the compiler. Only the local targets of `envs`
+        whose rule is one of :data:`_COMPDB_RULES` are listed, in the order of the build files.
+        args:
+            stream: JSON file written as it goes
+    '''
+    def entries():
+        flavours = [flavour for flavour in root.all_flavours if flavour.name == flavour_name]
+        scope = _NinjaScope(_injected_lines(root, flavours))
+        for env_ in envs:
+            flavour = next((flavour for flavour in env_.all_flavours if flavour.name == flavour_name), None)
+            if flavour is None:
+                continue
+            resolvers = {}
+            local_scope = _NinjaScope(_env_flag_lines(env_, flavour), scope)
+            for target in filter(lambda target: target.rule in _COMPDB_RULES, graph.local_targets(env_)):
+                flavour_dependant = all('{flavour}' in str(output) for output in chain(target.outputs, target.implicit_outputs))
+                target_flavour = flavour if flavour_dependant else DEFAULT_FLAVOUR
+                resolve_escape_join_ = _resolver(resolvers, env_, target_flavour).join
+                inputs = [str(input_) for input_ in resolve(target.inputs, env=env_, flavour=target_flavour)]
+                outputs = [str(output) for output in resolve(target.outputs, env=env_, flavour=target_flavour)]
+                bindings = chain((_flag_line(flag, flag.value, resolve_escape_join_) for flag in graph.target_flags(target, target_flavour)), ('COMPILER_LAUNCHER=',))
+                command = (local_scope if flavour_dependant else scope).command(target.rule, bindings, inputs, outputs)
+                yield dict(directory=str(root.base_dir), command=command, file=inputs[0], output=outputs[0])
+
+    stream.write('[')
+    for index, entry in enumerate(entries()):
+        stream.write(f'{"," if index else ""}\n  {json.dumps(entry)}')
+    stream.write('\n]\n')
+
+
+def _generate_compdb(env, graph) -> dict:  # pylint:disable=redefined-outer-name
+    ''' Writes the compilation database of each flavour of `env`, listing the targets of its first class sub environments too (see --compdb)
+
+        returns:
+            dict: {generated file: whether it was rewritten}
+    '''
+    generated = {}
+    for flavour in env.all_flavours:
+        filename = Path(next(resolve(env.get_build_path(flavour) / _COMPDB_FILE, env=env, flavour=flavour)))
+        logging.debug(f'generate {filename!s}')
+        with _span(str(filename), 'file'), _StreamedFile(filename) as stream:
+            _write_compdb(stream, env, (env, *graph.first_class_subenvs(env)), graph, flavour.name)
+        generated[filename] = stream.replaced
+    return generated
+
+
+def _generate_env(env, graph):  # pylint:disable=redefined-outer-name
+    with _span(str(env.base_dir), 'env'):
+        return _generate_env_files(env, graph)
+
+
+def _generate_env_files(env, graph):  # pylint:disable=redefined-outer-name
+    phony_inputs = graph.phony_inputs
+    first_class_subenvs = graph.first_class_subenvs(env)
+
+    generated, resolvers = {}, {}  # resolvers: see _resolver, dropped with the paths they cache once the files of env are written
     with ExitStack() as stack:
         def file_(filename, flavour=None):
             @contextmanager
             def context_(filename):
-                try:
-                    logging.debug(f'generate {filename!s}')
-                    filename.parent.mkdir(parents=True, exist_ok=True)
-                    with filename.open('w') as out:
-                        yield out
-                except:
-                    filename.unlink()
-                    raise
+                logging.debug(f'generate {filename!s}')
+                with _async_span(str(filename), 'file'), _StreamedFile(filename) as stream:
+                    yield stream
+                generated[filename] = stream.replaced
             return stack.enter_context(context_(Path(next(resolve(filename, env=env, flavour=flavour)))))
 
         main_build_file = file_(env.base_dir / env.ninja_file.name)
@@ -541,77 +1599,411 @@ def _generate_env(env):  # pylint:disable=redefined-outer-name
         main_build_file.write(f'ninja_required_version=1.8\n')
         if _BUILD_DIR is not None:
             main_build_file.write(f'builddir={escape(_BUILD_DIR)}\n')
-        main_build_file.write(f'include {escape(_get_resource_file("common.ninja_inc"))}\n')
-        main_build_file.write(f'PYTHON={escape(sys.executable)}\n')
-        main_build_file.writelines(f'{line}\n' for line in OrderedDict(zip(chain.from_iterable(injection(env, flavour).splitlines() for injection in env.all_injections for flavour in env.all_flavours), repeat(None))).keys())
-        main_build_file.writelines(f'subninja {escape(subenv.base_dir / f"common_{subenv.ninja_file.name}")}\n' for subenv in (env, *env.first_class_subenvs))
+        main_build_file.writelines(f'{line}\n' for line in chain(_injected_lines(env, env.all_flavours), _pool_lines(env, env.all_flavours)))
+        main_build_file.writelines(f'subninja {escape(subenv.base_dir / f"common_{subenv.ninja_file.name}")}\n' for subenv in (env, *first_class_subenvs))
 
         for flavour in env.all_flavours:
-            resolve_escape_join_ = partial(resolve_escape_join, env=env, flavour=flavour)
+            resolve_escape_join_ = _resolver(resolvers, env, flavour).join
 
-            build_files[flavour.name].write(f'include {escape(_get_resource_file("common.ninja_inc"))}\n')
-            build_files[flavour.name].write(f'PYTHON={escape(sys.executable)}\n')
-            build_files[flavour.name].writelines(f'{line}\n' for line in OrderedDict(zip(chain.from_iterable(injection(env, flavour).splitlines() for injection in env.all_injections), repeat(None))).keys())
-            build_files[flavour.name].writelines(f'subninja {resolve_escape_join_(subenv.base_dir / f"common_{subenv.ninja_file.name}")}\n' for subenv in (env, *env.first_class_subenvs))
+            build_files[flavour.name].writelines(f'{line}\n' for line in chain(_injected_lines(env, (flavour,)), _pool_lines(env, (flavour,))))
+            build_files[flavour.name].writelines(f'subninja {resolve_escape_join_(subenv.base_dir / f"common_{subenv.ninja_file.name}")}\n' for subenv in (env, *first_class_subenvs))
             
-            local_files[flavour.name].writelines(f'{flag.name}={resolve_escape_join_((f"${flag.name}", flag.value) if flag.append else flag.value)}\n' for flag in get_env_flags(env, flavour))
+            local_files[flavour.name].writelines(f'{line}\n' for line in _env_flag_lines(env, flavour))
 
             for out_file in (main_build_file, build_files[flavour.name]):
-                out_file.writelines(f'subninja {resolve_escape_join_(subenv.get_build_path() / f"local_{subenv.ninja_file.name}")}\n' for subenv in (env, *env.first_class_subenvs))
+                out_file.writelines(f'subninja {resolve_escape_join_(subenv.get_build_path() / f"local_{subenv.ninja_file.name}")}\n' for subenv in (env, *first_class_subenvs))
             
-            defaults = phony_inputs(target for target in env.all_defaults if isinstance(target, _Target)) or tuple(phony_inputs(subenv.terminal_targets) for subenv in (env, *env.first_class_subenvs))
+            defaults = phony_inputs(target for target in env.all_defaults if isinstance(target, _Target)) or tuple(phony_inputs(graph.terminal_targets(subenv)) for subenv in (env, *first_class_subenvs))
             main_build_file.write(f'build {flavour.name} : phony {resolve_escape_join_(defaults)}\n')
 
-            for output, items in groupby(sorted(((resolve_escape_join_(target.outputs[0]), target) for target in env.all_targets if target.rule == 'phony'), key=itemgetter(0)), key=itemgetter(0)):
-                build_files[flavour.name].write(f'build {output} : phony {resolve_escape_join_(phony_inputs(target for _, target in items))}\n')
+            for output, targets in _group_by(graph.phony_targets(env), key=lambda target: resolve_escape_join_(target.outputs[0])):  # pylint:disable=cell-var-from-loop
+                build_files[flavour.name].write(f'build {output} : phony {resolve_escape_join_(phony_inputs(targets))}\n')
+
+        phony_items = ((target, flavour) for target in graph.phony_targets(env) for flavour in env.all_flavours)
+        for output, items in _group_by(phony_items, key=lambda item: _resolver(resolvers, env, item[1]).join(item[0].outputs[0])):
+            main_build_file.write(f'build {output} : phony {" ".join(_resolver(resolvers, env, flavour).join(phony_inputs((target,))) for target, flavour in items)}\n')
+
+        hoisted = {}  # (file, environment, flavour name): {flag name: (variable, values)} of the local flags written as file scope variables
+
+        def hoisted_flags(out_file, env_, flavour):
+            ''' Defines the variables holding the local flags of `env_` in `out_file`, the first time they are needed there '''
+            key = id(out_file), id(env_), flavour.name
+            if key not in hoisted:
+                local_flags = {flag.name: (f'_ENV{len(hoisted)}_{flag.name}', _flag_values(flag)) for flag in graph.local_flags(env_, flavour)}
+                out_file.writelines(f'{variable}={_resolver(resolvers, env, flavour).join(values)}\n' for variable, values in local_flags.values())
+                hoisted[key] = local_flags
+            return hoisted[key]
+
+        shards = {}  # (directory, flavour name or None for the common build file): file, see --shard
 
-        for output, items in groupby(sorted(((resolve_escape_join(target.outputs[0], env=env, flavour=flavour), target, flavour) for target in env.all_targets if target.rule == 'phony' for flavour in env.all_flavours), key=itemgetter(0)), key=itemgetter(0)):
-            main_build_file.write(f'build {output} : phony {" ".join(resolve_escape_join(phony_inputs((target,)), env=env, flavour=flavour) for _, target, flavour in items)}\n')
+        def shard_file(directory, flavour):
+            ''' File of the targets of the local sub environments whose sources are in `directory`, included by the local or common build file of env '''
+            key = directory, flavour and flavour.name
+            if key not in shards:
+                filename = (env.get_build_path(flavour) if flavour else env.base_dir / env.build_dir) / _shard_dir(env, directory) / (f'{"local" if flavour else "common"}_{env.ninja_file.name}')
+                shards[key] = filename, file_(filename, flavour)
+            return shards[key][1]
 
-        for target in filter(lambda target: target.rule != 'phony', env.local_targets):
+        for target in filter(lambda target: target.rule != 'phony', graph.local_targets(env)):
             flavour_dependant = all('{flavour}' in str(output) for output in chain(target.outputs, target.implicit_outputs))
             for flavour in (env.all_flavours if flavour_dependant else (DEFAULT_FLAVOUR,)):
-                resolve_escape_join_ = partial(resolve_escape_join, env=env, flavour=flavour)
-                out_file = local_files[flavour.name] if flavour_dependant else common_build_file
+                resolve_escape_join_ = _resolver(resolvers, env, flavour).join
+                if _SHARD and target.env.get_source_path() != env.get_source_path():
+                    out_file = shard_file(target.env.get_source_path(), flavour if flavour_dependant else None)
+                else:
+                    out_file = local_files[flavour.name] if flavour_dependant else common_build_file
+                local_flags = hoisted_flags(out_file, target.env, flavour) if _HOIST_FLAGS and target.env.local_flags else {}
                 out_file.write(f'build {resolve_escape_join_(target.outputs)} {("| " + resolve_escape_join_(target.implicit_outputs)) if target.implicit_outputs else ""} : {target.rule} {resolve_escape_join_(target.inputs)} {("| " + resolve_escape_join_(target.implicit_inputs)) if target.implicit_inputs else ""}  {("|| " + resolve_escape_join_(target.order_only_inputs)) if target.order_only_inputs else ""}\n')
-                out_file.writelines(f'  {flag.name}={resolve_escape_join_((f"${flag.name}", flag.value) if flag.append else flag.value)}\n' for flag in get_target_flags(target, flavour))
+                for flag in graph.target_flags(target, flavour):
+                    value = _hoist_flag_value(flag, *local_flags.get(flag.name, ('', ())))
+                    out_file.write(f'  {_flag_line(flag, value, resolve_escape_join_)}\n')
+
+        for (_, flavour_name), (filename, _) in shards.items():
+            (local_files[flavour_name] if flavour_name else common_build_file).write(f'subninja {escape(filename)}\n')
 
         for flavour in env.all_flavours:
             for out_file in (main_build_file, build_files[flavour.name]):
                 if env.all_defaults:
-                    out_file.write(f'default {" ".join(set(resolve_escape_join_(default) for default in env.all_defaults))}\n')
+                    out_file.write(f'default {" ".join(_ordered_set(resolve_escape_join_(default) for default in env.all_defaults))}\n')
+
+        if _COMPDB == 'env':
+            for flavour in env.all_flavours:
+                _write_compdb(file_(env.get_build_path(flavour) / _COMPDB_FILE, flavour), env, (env,), graph, flavour.name)
+
+        deps_file = file_(env.base_dir / (f'{env.ninja_file.name}.d'))
+        deps_file.write(str(env.ninja_file) + ' : ' + ' '.join(str(dep).replace(' ', r'\ ') for dep in sorted(env.dependencies)))
+
+    return generated
+
+
+def _shard_dir(env, directory) -> PurePath:  # pylint:disable=redefined-outer-name
+    ''' Directory of the shards of the targets whose sources are in `directory`, relative to the build directory of `env` (see --shard)
+
+        Named after the path of `directory` relative to the base directory of `env`, `..` becoming `__`: stable from a generation to the next
+    '''
+    return PurePath('shards', *('__' if part == '..' else part for part in PurePath(relpath(directory, env.base_dir)).parts))
+
+
+def _generate_env_job(index):
+    ''' returns: tuple: files generated, spans recorded by a forked worker (to be merged into the tracer of the parent) '''
+    graph, envs, parent = _GENERATION
+    if not _TRACER or getpid() == parent:
+        return _generate_env(envs[index], graph), None
+    _TRACER.take()  # inherited from the parent
+    generated = _generate_env(envs[index], graph)
+    return generated, _TRACER.take()
+
+
+def _executor(jobs):
+    ''' Process pool whose workers are forked once the graph is compiled, so that nothing has to be pickled but the results
+        Thread pool where fork is not available, or not safe (macOS: system libraries may have started threads)
+
+        No other thread is running by then (see :func:`_shutdown_prjdef_executor`): a lock held by another thread at fork time (logging,
+        imports) would be held forever in the workers.
+    '''
+    if sys.platform.startswith('linux') and 'fork' in get_all_start_methods():
+        return ProcessPoolExecutor(max_workers=jobs, mp_context=get_context('fork'))
+    return ThreadPoolExecutor(max_workers=jobs)
+
+
+def generate(env, graph=None, *, jobs=1):  # pylint:disable=redefined-outer-name
+    ''' Writes the ninja files of `env` and of its first class sub environments
+        Files whose content did not change are left untouched (neither rewritten nor their mtime updated)
+
+        args:
+            env: root environment, as returned by :func:`parse`
+            graph: result of :func:`compile_graph` for `env`, compiled if not provided
+            jobs: number of environments generated in parallel; the files are the same as with a single job
+        returns:
+            tuple: paths of the generated files
+    '''
+    global _GENERATION
+    graph = graph or compile_graph(env)
+    envs = (env, *graph.first_class_subenvs(env))
+    if jobs > 1 and len(envs) > 1:
+        _GENERATION = graph, envs, getpid()
+        try:
+            with _executor(min(jobs, len(envs))) as executor:
+                results = tuple(executor.map(_generate_env_job, range(len(envs))))
+        finally:
+            _GENERATION = None
+        for _, taken in filter(itemgetter(1), results):
+            _TRACER.merge(taken)
+        results = map(itemgetter(0), results)
+    else:
+        results = (_generate_env(subenv, graph) for subenv in envs)
+    generated = dict(chain.from_iterable(result.items() for result in results))
+    if _COMPDB == 'flavour':
+        generated.update(_generate_compdb(env, graph))
+    rewritten = sum(generated.values())
+    logging.info(f'{rewritten} file(s) rewritten, {len(generated) - rewritten} unchanged')
+    return tuple(generated)
+
+
+def _digest_file(path):
+    try:
+        with open(path, 'rb') as stream:
+            digest = sha256()
+            for chunk in iter(partial(stream.read, 1 << 16), b''):
+                digest.update(chunk)
+            return digest.hexdigest()
+    except OSError:
+        return None
+
+
+class _StreamedFile(object):
+    ''' Text file written to a temporary file next to `filename` and hashed as it goes, so that memory use does not depend on its size
+        On exit, the temporary file atomically replaces `filename`, unless they have the same content: `replaced` tells which
+
+        Newlines are written as they are (`\\n`, on Windows too): the bytes hashed are the bytes written. The temporary file is named
+        after the process and the thread, several generations (a daemon, another one in process) may write the same file at once.
+    '''
+
+    def __init__(self, filename):
+        filename.parent.mkdir(parents=True, exist_ok=True)
+        self.__filename, self.__temporary = filename, filename.with_name(f'.{filename.name}.{getpid()}.{get_ident()}.tmp')
+        self.__stream, self.__digest = self.__temporary.open('w', newline=''), sha256()
+        self.replaced = None
+
+    def write(self, text):
+        self.__digest.update(text.encode(self.__stream.encoding))
+        self.__stream.write(text)
 
-        with file_(env.base_dir / (f'{env.ninja_file.name}.d')) as deps_file:
-            deps_file.write(str(env.ninja_file) + ' : ' + ' '.join(str(dep).replace(' ', r'\ ') for dep in sorted(env.dependencies)))
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
 
+    def __enter__(self):
+        return self
 
-def generate(env):  # pylint:disable=redefined-outer-name
-    for subenv in (env, *env.first_class_subenvs):
-        _generate_env(subenv)
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.__stream.close()
+        if exc_type is not None or self.__digest.hexdigest() == _digest_file(self.__filename):
+            self.__temporary.unlink()
+            self.replaced = False
+        else:
+            replace(str(self.__temporary), str(self.__filename))
+            self.replaced = True
+
+
+def _digest_glob(root, pattern):
+    return sha256('\n'.join(sorted(_DIRECTORY_INDEX.glob(root, pattern))).encode()).hexdigest()
+
+
+def _cache_key(args):
+    ''' Hash of what the generated files depend on besides the prjdefs: genjutsu, the interpreter written into them, the options, and the
+        machine resources the depths of the pools are computed from (see :func:`_pool_depth`)
+    '''
+    return sha256(repr((__version__, sys.version, sys.executable, _machine_resources(), _TOOLSETS, tuple(map(str, _RESOURCE_PATH)), sorted((name, str(value)) for name, value in vars(args).items() if name not in _NEUTRAL_OPTIONS))).encode()).hexdigest()
+
+
+def _is_cache_valid(cache_file, key):
+    ''' True if the outputs recorded in `cache_file` exist and none of the recorded inputs (files and globs) changed content '''
+    try:
+        cache = json.loads(cache_file.read_text())
+    except (OSError, ValueError):
+        return False
+    return (cache.get('key') == key
+            and all(Path(output).is_file() for output in cache['outputs'])
+            and all(_digest_file(dependency) == digest for dependency, digest in cache['dependencies'].items())
+            and all(_digest_glob(root, pattern) == digest for root, pattern, digest in cache['globs']))
+
+
+def _write_cache(cache_file, key, env, outputs, *, digest_file=_digest_file, digest_glob=_digest_glob):  # pylint:disable=redefined-outer-name
+    cache = dict(key=key,
+                 outputs=sorted(map(str, outputs)),
+                 dependencies={str(dependency): digest_file(dependency) for dependency in chain(env.dependencies, (env.prj_file,))},
+                 globs=sorted((str(root), pattern, digest_glob(root, pattern)) for root, pattern in env.globs))
+    with suppress(OSError):
+        cache_file.write_text(json.dumps(cache, indent=1))
+
+
+def _signature(path):
+    try:
+        status = stat(path)
+        return status.st_mtime_ns, status.st_size
+    except OSError:
+        return None
+
+
+class _Daemon(object):
+    ''' Keeps the prjdefs parsed from one generation to the next, see --daemon
+
+        Before each generation, the files the prjdefs depend on are checked (their stat, then their content if their stat changed), as
+        well as their globs: the prjdefs depending on a changed input are evaluated again, with the prjdefs including them, the other ones
+        are reused as they are. So are the files of the first class environments which were not evaluated again.
+    '''
+
+    def __init__(self, path, cache_file, cache_key):
+        self.__path, self.__cache_file, self.__cache_key = path, cache_file, cache_key
+        self.__inputs, self.__globs, self.__outputs = {}, {}, {}  # {path: (signature, digest)}, {(root, pattern): digest}, {env (None for --compdb): {filename: replaced}}
+        _PRJDEFS.clear()
+
+    def generate(self):
+        ''' returns:
+                tuple: numbers of files rewritten and unchanged, None if a Python module changed (the daemon must be restarted)
+        '''
+        _DIRECTORY_INDEX.new_run()
+        signatures = {path: _signature(path) for path in self.__inputs}
+        changed = frozenset(path for path, (signature, digest) in self.__inputs.items() if signatures[path] != signature and _digest_file(path) != digest)
+        changed_globs = frozenset(glob for glob, digest in self.__globs.items() if _digest_glob(*glob) != digest)
+        if changed and not changed.isdisjoint(Path(module.__file__).resolve() for module in tuple(sys.modules.values()) if getattr(module, '__file__', None)):
+            return None
+        for key, prjdef in tuple(_PRJDEFS.items()):
+            if not (changed.isdisjoint(prjdef.result().E.dependencies) and changed_globs.isdisjoint(prjdef.result().E.globs)):
+                logging.debug(f'{key[0]!s} changed')
+                del _PRJDEFS[key]
+
+        env = _parse(self.__path).E  # pylint:disable=redefined-outer-name
+        reached = {env, *env.all_subenvs}
+        for key, prjdef in tuple(_PRJDEFS.items()):
+            if prjdef.result().E not in reached:
+                del _PRJDEFS[key]
+        graph = compile_graph(env)
+        outputs, rewritten, reused = {}, 0, True
+        for env_ in (env, *graph.first_class_subenvs(env)):
+            generated = self.__outputs.get(env_)
+            if generated is None or not all(map(exists, generated)):
+                generated, reused = _generate_env(env_, graph), False
+                rewritten += sum(generated.values())
+            outputs[env_] = generated
+        if _COMPDB == 'flavour':  # lists the targets of every environment, written again if any of them was generated again
+            generated = self.__outputs.get(None)
+            if generated is None or not reused or not all(map(exists, generated)):
+                generated = _generate_compdb(env, graph)
+                rewritten += sum(generated.values())
+            outputs[None] = generated
+        self.__outputs = outputs
+
+        previous = self.__inputs  # signatures taken before parsing: files changed since then are checked again by the next generation
+        self.__inputs = {path: (signatures[path], previous[path][1]) if path in previous and path not in changed else (_signature(path), _digest_file(path)) for path in chain(env.dependencies, (env.prj_file,))}
+        self.__globs = {glob: _digest_glob(*glob) for glob in env.globs}
+        _write_cache(self.__cache_file, self.__cache_key, env, chain.from_iterable(outputs.values()), digest_file=lambda path: self.__inputs[path][1], digest_glob=lambda *glob: self.__globs[glob])
+        return rewritten, sum(map(len, outputs.values())) - rewritten
+
+    def serve(self, daemon_file):
+        ''' Generates, then again on each request of :func:`_request_daemon` until interrupted, or until a Python module changed '''
+        logging.info('{} file(s) rewritten, {} unchanged'.format(*self.generate()))
+        authkey = urandom(16)
+        with Listener(authkey=authkey) as listener, ExitStack() as stack:
+            with suppress(ValueError):  # not the main thread
+                stack.callback(signal, SIGTERM, signal(SIGTERM, lambda *_: sys.exit(0)))
+            with open(daemon_file, 'w', opener=lambda path, flags: os_open(path, flags, 0o600)) as stream:
+                stack.callback(lambda: daemon_file.unlink() if daemon_file.exists() else None)
+                json.dump(dict(address=listener.address, authkey=authkey.hex(), key=self.__cache_key), stream)
+            logging.info(f'{self.__path!s}: daemon listening')
+            while True:
+                try:
+                    connection = listener.accept()
+                except (OSError, AuthenticationError) as error:
+                    logging.warning(f'rejected request: {error!r}')
+                    continue
+                except KeyboardInterrupt:
+                    return
+                result = False
+                with connection, suppress(OSError, EOFError):  # the client is gone
+                    connection.recv()
+                    try:
+                        with _span('generate', 'daemon'):
+                            result = self.generate()
+                    except Exception:  # pylint:disable=broad-except
+                        logging.exception('generation failed')  # the client generates by itself, reporting the error
+                    connection.send(result)
+                if result is None:
+                    logging.info(f'{self.__path!s}: Python modules changed, daemon stopped')
+                    return
+
+
+def _request_daemon(daemon_file, cache_key):
+    ''' Asks the daemon whose address is in `daemon_file` to generate
+
+        returns:
+            bool: True if it did, False if there is no such daemon, if it was started with other options, or if it failed
+    '''
+    try:
+        daemon = json.loads(daemon_file.read_text())
+        if daemon['key'] != cache_key:
+            return False
+        with Client(daemon['address'], authkey=bytes.fromhex(daemon['authkey'])) as connection:
+            connection.send('generate')
+            result = connection.recv()
+    except (OSError, ValueError, KeyError, EOFError, AuthenticationError):
+        return False
+    if result:
+        logging.info('{} file(s) rewritten, {} unchanged (daemon)'.format(*result))
+    return bool(result)
+
+
+def _write_timings(tracer, timings_file, trace_file):
+    if timings_file == Path('-'):
+        for category, names in tracer.summary().items():
+            for name, entry in sorted(names.items(), key=lambda item: -item[1]['seconds']):
+                logging.info(f'{category} {name}: {entry["seconds"]:.3f}s ({entry["count"]})')
+    elif timings_file:
+        timings_file.write_text(json.dumps(tracer.summary(), indent=1))
+    if trace_file:
+        trace_file.write_text(json.dumps(tracer.trace()))
 
 
 def main(**kwargs):
     parser = ArgumentParser()
     parser.add_argument('--logging-ini')
     parser.add_argument('--builddir', type=Path, default=None, help='ninja builddir variable')
+    parser.add_argument('--no-cache', action='store_true', help=f'always regenerate, ignoring the {_CACHE_FILE} file next to the prjdef')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='number of first class environments generated in parallel')
+    parser.add_argument('--persist-index', action='store_true', help=f'keep the directories walked by Glob() in a {_INDEX_FILE} file next to the prjdef, not to scan them again while unchanged')
+    parser.add_argument('--timings', type=Path, default=None, help='write the time spent by phase, prjdef, toolset, environment and file to TIMINGS as JSON, or log it if TIMINGS is -')
+    parser.add_argument('--trace', type=Path, default=None, help='write the timed spans to TRACE, in the Chrome trace event format (chrome://tracing, Perfetto)')
+    parser.add_argument('--hoist-flags', action='store_true', help='write the local flags of the environments once per file, as variables referenced by the flags of their targets')
+    parser.add_argument('--shard', action='store_true', help='write the targets of the sub environments of each directory to their own build files, included by the ones of their first class environment')
+    parser.add_argument('--compdb', action='store_const', const='flavour', help=f'write the compilation database of each flavour ({_COMPDB_FILE}) in the build directory of the flavour')
+    parser.add_argument('--compdb-shards', dest='compdb', action='store_const', const='env', help='write the compilation databases of each first class environment in its own build directories, instead of --compdb')
+    parser.add_argument('--daemon', action='store_true', help=f'stay resident once generated, to generate again on the requests of --client (its address is kept in a {_DAEMON_FILE} file next to the prjdef)')
+    parser.add_argument('--client', action='store_true', help='have the --daemon of the prjdef generate, generate in process if there is none')
     parser.add_argument('input', type=Path, default=Path.cwd(), help='prjdef file (or directory containing one)')
     args = parser.parse_args(**kwargs)
 
-    global _BUILD_DIR
-    _BUILD_DIR = args.builddir
+    global _BUILD_DIR, _BYTECODE_DIR, _COMPDB, _HOIST_FLAGS, _SHARD, _TRACER
+    _BUILD_DIR, _COMPDB, _HOIST_FLAGS, _SHARD = args.builddir, args.compdb, args.hoist_flags, args.shard
+    _TRACER = _Tracer() if args.timings or args.trace else None
 
     if args.logging_ini:
         logging.config.fileConfig(args.logging_ini)
     else:
         logging.basicConfig(level=logging.INFO)
 
-    env = parse(args.input).E
-
-    for name, attribute in vars(Env).items():
-        if isinstance(attribute, property):
-            setattr(Env, name, property(lru_cache(maxsize=1)(attribute.fget)))
-
-    generate(env)
+    prjdef = args.input / 'prjdef' if args.input.is_dir() else args.input
+    cache_file, cache_key, index_file = prjdef.resolve().parent / _CACHE_FILE, _cache_key(args), prjdef.resolve().parent / _INDEX_FILE
+    _BYTECODE_DIR = prjdef.resolve().parent / (args.builddir or _ENV_BUILD_DIR) / '__pycache__'  # the root environment is built with no arguments
+    if args.client and _request_daemon(prjdef.resolve().parent / _DAEMON_FILE, cache_key):
+        return
+    if args.persist_index:
+        _DIRECTORY_INDEX.load(index_file)
+    try:
+        if args.daemon:
+            _Daemon(args.input, cache_file, cache_key).serve(prjdef.resolve().parent / _DAEMON_FILE)
+            return
+
+        with _span('cache', 'phase'):
+            if not args.no_cache and _is_cache_valid(cache_file, cache_key):
+                logging.info(f'{prjdef!s}: no input changed, skip generation')
+                return
+
+        with _span('parse', 'phase'):
+            env = parse(args.input).E
+
+        with _span('graph', 'phase'):
+            graph = compile_graph(env)
+        with _span('generate', 'phase'):
+            generated = generate(env, graph, jobs=args.jobs)
+        with _span('cache', 'phase'):
+            _write_cache(cache_file, cache_key, env, generated)
+    finally:
+        if args.persist_index:
+            _DIRECTORY_INDEX.save(index_file)
+        if _TRACER:
+            _write_timings(_TRACER, args.timings, args.trace)
+            _TRACER = None
 
 
 if __name__ == '__main__':
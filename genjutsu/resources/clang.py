@@ -6,7 +6,8 @@ from genjutsu import toolset_class
 _COMPILER_NAME = 'clang'
 _EXTRA_FLAVOURS = ('debug', 'release',
                    'profile', 'profile_instr_record', 'profile_instr_use', 'profile_sample_record', 'profile_sample_use',
-                   'sanitize_address', 'sanitize_thread', 'sanitize_memory', 'sanitize_undefined') 
+                   'sanitize_address', 'sanitize_thread', 'sanitize_memory', 'sanitize_undefined',
+                   'thinlto', 'fulllto')
 
 _GnuToolset = toolset_class('gnu_toolsets.GnuToolset')
 _BundleToolset = toolset_class('gnu_toolsets.BundleToolset')
@@ -21,5 +22,13 @@ class CompilerToolset0(_GnuToolset, compiler_name=_COMPILER_NAME, flavours=_EXTR
 class LinkerToolset(_GnuToolset, compiler_name=_COMPILER_NAME, kind=_GnuToolset.KIND_LINKER):
     pass
 
+class LinkerToolset0(_GnuToolset, compiler_name=_COMPILER_NAME, kind=_GnuToolset.KIND_LINKER, flavours=_EXTRA_FLAVOURS):
+    'Clang genjutsu linker toolset including the flavours of CompilerToolset0 (thinlto and fulllto link with LTO)'
+    pass
+
 class Toolset(_BundleToolset, toolsets=(CompilerToolset, LinkerToolset)):
     pass
+
+class Toolset0(_BundleToolset, toolsets=(CompilerToolset0, LinkerToolset0)):
+    'Clang genjutsu toolset including profile/sanitize/LTO flavours'
+    pass
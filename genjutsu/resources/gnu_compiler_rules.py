@@ -1,9 +1,11 @@
 '''
 Rules for toolsets following the CLI of GCC (namely GCC and Clang)
 '''
+from hashlib import sha256
 from itertools import chain
 from pathlib import Path
-from genjutsu import Alias, E, Flag, Target
+from platform import system
+from genjutsu import Alias, E, Flag, Target, Variable
 
 
 def CxxFlag(*args): #pylint: disable=invalid-name,missing-docstring
@@ -18,8 +20,23 @@ def CxxDef(key, value=None): #pylint: disable=invalid-name,missing-docstring
     return CxxFlag(*(('-D', key, '=', value) if value is not None else ('-D', key)))
 
 
-def Pch(pch, **kwargs): #pylint: disable=invalid-name,missing-docstring
-    return Target((E.source_path / pch,), ((E.build_path / pch).with_suffix('.pch'),), 'pch', **kwargs)
+def CompilerLauncher(launcher): #pylint: disable=invalid-name
+    ''' Flags running the `cxx` and `pch` commands through `launcher` (ccache, sccache), with the paths under the current environment
+        mapped to relative ones (CCACHE_BASEDIR, -fdebug-prefix-map) so that checkouts in other directories share the cache entries;
+        with None, flags disabling it (as flavours do, see `gnu_toolsets.GnuToolset`)
+
+        On Windows, ninja runs commands without a shell: CCACHE_BASEDIR cannot be set by the command, but in the environment of ninja.
+        The flags of sub environments and targets override the ones of the flavours: applied there, the launcher also runs the compilations
+        of the flavours which disable it
+    '''
+    if launcher is None:
+        return (Variable('COMPILER_LAUNCHER', ''),)
+    base_dir = ('CCACHE_BASEDIR=', E.base_dir, ' ') if system() != 'Windows' else ()
+    return Variable('COMPILER_LAUNCHER', (*base_dir, launcher, ' ')), CxxFlag('-fdebug-prefix-map=', E.base_dir, '=.')
+
+
+def Pch(pch, *, flags=(), pool='pch', **kwargs): #pylint: disable=invalid-name,missing-docstring
+    return Target((E.source_path / pch,), ((E.build_path / pch).with_suffix('.pch'),), 'pch', flags=chain((Variable('pool', pool),) if pool else (), flags), **kwargs)
 
 
 def Cxx(cxx, *, pch=None, implicit_inputs=(), flags=(), quick_build_alias='{source}:{flavour}', **kwargs): #pylint: disable=invalid-name,missing-docstring
@@ -31,3 +48,40 @@ def Cxx(cxx, *, pch=None, implicit_inputs=(), flags=(), quick_build_alias='{sour
     if quick_build_alias is not None:
         Alias(quick_build_alias.format(source=E.source_path / cxx, flavour='{flavour}'), (result,))
     return result
+
+
+def _unity_batches(sources, batch_size):
+    ''' Cuts `sources` before the sources whose path hash is a multiple of half `batch_size`, once a batch has half of it (or twice of it)
+
+        Inserting or removing a source changes its batch and seldom the next ones, whereas cutting every `batch_size` sources would shift
+        all the batches following it. Sources are cut in the order of their paths, so that batches do not depend on the order of `sources`,
+        but keep the order of `sources` within their batch: a translation unit includes them as they were given.
+    '''
+    batches = []
+    for source in sorted(sources, key=str):
+        size = len(batches[-1]) if batches else 2 * batch_size
+        if size >= 2 * batch_size or (size >= (batch_size + 1) // 2 and int(sha256(str(source).encode()).hexdigest(), 16) % max(batch_size // 2, 1) == 0):
+            batches.append([])
+        batches[-1].append(source)
+    order = {source: index for index, source in reversed(tuple(enumerate(sources)))}
+    return [sorted(batch, key=order.__getitem__) for batch in batches]
+
+
+def Unity(sources, *, batch_size=8, name='unity', pch=None, implicit_inputs=(), flags=(), quick_build_alias='{source}:{flavour}', **kwargs): #pylint: disable=invalid-name,too-many-arguments
+    ''' Objects compiling `sources` in batches of about `batch_size` sources, each one included by a generated translation unit
+
+        The quick build alias of each source builds the object of its batch, not an object of its own: such an object would not be the
+        input of any target, and would then be built by default along with its batch.
+        returns:
+            list: objects, to be linked in place of the ones of :func:`Cxx`
+    '''
+    sources = [source.outputs[0] if hasattr(source, 'outputs') else E.source_path / source for source in sources]
+    objects = []
+    for batch in _unity_batches(sources, batch_size):
+        unity = f'{name}_{sha256(min(map(str, batch)).encode()).hexdigest()[:16]}'
+        result = Cxx(Target(batch, (E.build_dir / 'unity' / f'{unity}.cpp',), 'unity'), pch=pch, implicit_inputs=implicit_inputs, flags=flags, quick_build_alias=None, **kwargs)
+        objects.append(result)
+        if quick_build_alias is not None:
+            for source in batch:
+                Alias(quick_build_alias.format(source=E.source_path / source, flavour='{flavour}'), (result,))
+    return objects
@@ -3,7 +3,7 @@ Rules for toolsets following the CLI of GCC (namely GCC and Clang)
 '''
 from itertools import chain
 from pathlib import Path
-from genjutsu import E, Flag, Target
+from genjutsu import E, Flag, Target, Variable, toolset_class
 
 
 def LinkFlag(*args): #pylint: disable=invalid-name,missing-docstring
@@ -18,13 +18,36 @@ def Lib(lib): #pylint: disable=invalid-name,missing-docstring
     return Flag('LDLIBS', ('-l', lib))
 
 
-def LinkerTarget(*args, libs=(), implicit_inputs=(), flags=(), **kwargs): #pylint: disable=invalid-name,missing-docstring
-    flags = chain(flags, *((LibDir(lib.outputs[0].parent), Lib(lib.outputs[0].stem[3:])) for lib in libs))
+def Linker(linker, *, threads=None, gdb_index=False, icf=None): #pylint: disable=invalid-name
+    ''' Flag linking with `linker` (`-fuse-ld=`), overriding the linker of the toolset; see `gnu_toolsets.GnuToolset.linker_options`
+        for the options, and the check that `linker` is installed
+        example: `Flavour('release', [Linker('lld', threads=8, icf='all')])`, `Apply(Linker('mold'))`
+    '''
+    return Variable('LINKER', toolset_class('gnu_toolsets.GnuToolset').linker_options(linker, threads=threads, gdb_index=gdb_index, icf=icf))
+
+
+def ThinLtoCachePolicy(policy): #pylint: disable=invalid-name
+    ''' Flag setting the pruning policy of the ThinLTO cache (`prune_after=72h:cache_size_bytes=20g`...), to be added to the
+        `thinlto` flavour: `Flavour('thinlto', [ThinLtoCachePolicy(...)])` (see https://clang.llvm.org/docs/ThinLTO.html#cache-pruning);
+        spelt for the LLVM gold plugin, gold being the linker of the flavour
+    '''
+    return LinkFlag(f'-Wl,-plugin-opt,cache-policy={policy}')
+
+
+def LtoJobs(jobs): #pylint: disable=invalid-name
+    ''' Flag setting the number of threads of the ThinLTO backend of a link, to be added to the `thinlto` flavour (all the hardware
+        threads by default); links are already run concurrently by the `link` pool
+    '''
+    return LinkFlag(f'-Wl,-plugin-opt,jobs={jobs}')
+
+
+def LinkerTarget(*args, libs=(), implicit_inputs=(), flags=(), pool='link', **kwargs): #pylint: disable=invalid-name,missing-docstring
+    flags = chain((Variable('pool', pool),) if pool else (), flags, *((LibDir(lib.outputs[0].parent), Lib(lib.outputs[0].stem[3:])) for lib in libs))
     return Target(*args, implicit_inputs=chain(libs, implicit_inputs), flags=flags, **kwargs)
 
 
-def Archive(archive, objects, **kwargs): #pylint: disable=invalid-name,missing-docstring
-    return LinkerTarget(objects, (E.build_path / ('lib' + archive + '.a'),), 'ar', **kwargs)
+def Archive(archive, objects, *, pool=None, **kwargs): #pylint: disable=invalid-name,missing-docstring
+    return LinkerTarget(objects, (E.build_path / ('lib' + archive + '.a'),), 'ar', pool=pool, **kwargs)
 
 
 def SharedObject(so, objects, **kwargs): #pylint: disable=invalid-name,missing-docstring
@@ -4,8 +4,9 @@ Clang genjutsu toolset
 from pathlib import Path
 from platform import system
 from os import environ
+from shutil import which
 
-from genjutsu import Default, Flavour, Flag, Inject, escape
+from genjutsu import E, Default, Flavour, Flag, Inject, Pool, Variable, compile_cached, escape
 
 _RESOURCE_DIR = Path(__file__).resolve().parent
 
@@ -14,30 +15,88 @@ class GnuToolset:
     KIND_COMPILER, KIND_LINKER = 'compiler', 'linker'
     __FLAGS = { KIND_COMPILER: ('CPPFLAGS', 'CFLAGS', 'CXXFLAGS'),
                 KIND_LINKER: ('LDFLAGS',)}
+    # pools of the heavy actions (see `Pch`, `Executable` and `SharedObject`), sized from the memory of a job at generation, shared by the
+    # flavours: building all of them at once does not run more jobs than the machine holds
+    __POOLS = { KIND_COMPILER: (('pch', 1 << 30),),
+                KIND_LINKER: (('link', 2 << 30),)}
+    # flavours compiled without COMPILER_LAUNCHER (see `CompilerLauncher`): compiler caches do not handle their profiles and runtimes
+    __UNCACHED_FLAVOURS = ('profile_instr_', 'profile_sample_', 'sanitize_')
+    # flavours linking with LTO: their objects hold bitcode, archived by an LTO aware AR (AR_LTO)
+    __LTO_FLAVOURS = ('thinlto', 'fulllto')
+    # linker of the LTO flavours: their `-Wl,-plugin-opt,` options (see `ThinLtoCachePolicy`, `LtoJobs`) are the ones of the LLVM gold plugin
+    __LTO_LINKER = '-fuse-ld=gold'
+    # linkers selected by `-fuse-ld=` (see `linker_options`): spelling of their thread count, None if they do not support the options
+    __LINKERS = {'bfd': None, 'gold': '-Wl,--threads,--thread-count={}', 'lld': '-Wl,--threads={}', 'mold': '-Wl,--thread-count={}'}
 
-    def __init_subclass__(cls, compiler_name, kind=KIND_COMPILER, flavours=('debug', 'release'), **kwargs):  #pylint: disable=missing-docstring
+    def __init_subclass__(cls, compiler_name, kind=KIND_COMPILER, flavours=('debug', 'release'), linker=None, **kwargs):  #pylint: disable=missing-docstring
         super().__init_subclass__(**kwargs)
         cls.__COMPILER_NAME = compiler_name
         cls.__KIND = kind
         cls.__FLAVOURS = flavours
+        cls.__LINKER = linker  # linker of the flavours (see `linker_options`), the default one of the compiler if None
 
     @classmethod
     def apply_to_env(cls):  #pylint: disable=missing-docstring
         system_name, *_ = system().lower().split('-')
+        if cls.__KIND == cls.KIND_COMPILER:
+            variables = (f'UNITY_SCRIPT={escape(_RESOURCE_DIR / "unity.py")}',)  # run by the `unity` rule, see `Unity`
+        else:  # overridden by the `Linker()` flags of the environments, flavours and targets
+            variables = (f'LINKER={cls.linker_options(cls.__LINKER)}',) if cls.__LINKER else ()
         Inject(lambda env, flavour: '\n'.join((f'include {escape(_RESOURCE_DIR / f"{cls.__COMPILER_NAME}-{system_name}.ninja_inc")}',
-                                               f'include {escape(_RESOURCE_DIR / f"gnu_{cls.__KIND}.ninja_inc")}')), key=cls)
-        flavours = [Flavour(flavour, flags=[Flag(flags, ('$' + flags + '_' + flavour.upper(),)) for flags in cls.__FLAGS[cls.__KIND]]) for flavour in cls.__FLAVOURS]
+                                               f'include {escape(_RESOURCE_DIR / f"gnu_{cls.__KIND}.ninja_inc")}', *variables)), key=cls)
+        flavours = [Flavour(flavour, flags=[*(Flag(flags, ('$' + flags + '_' + flavour.upper(),)) for flags in cls.__FLAGS[cls.__KIND]), *cls.__flavour_flags(flavour)])
+                    for flavour in cls.__FLAVOURS]
         Default(flavours[0])
+        for pool, job_memory in cls.__POOLS[cls.__KIND]:
+            Pool(pool, job_memory=job_memory)
 #        # set by vcvars.bat
 #        if system_name == 'windows':
 #            for path in environ.get('INCLUDE', '').split(';'):
 #                IncludeDir(path)
 
+    @classmethod
+    def linker_options(cls, linker, *, threads=None, gdb_index=False, icf=None):
+        ''' Options of the compiler driver linking with `linker`
+
+            args:
+                linker: `bfd`, `gold`, `lld`, `mold` or the path of one of them
+                threads: number of threads of the link
+                gdb_index: write a `.gdb_index` section, loaded faster by gdb
+                icf: identical code folding, `all` or `safe`
+            raises:
+                FileNotFoundError: `ld.<linker>` is not in the PATH: checked at generation rather than failing the first link of the build.
+                                   Only checked when the prjdef selecting `linker` is evaluated: a generation skipped by the cache, or a
+                                   daemon reusing the prjdef (see --daemon), does not check it again
+                ValueError: `linker` does not support the options
+        '''
+        path = Path(linker)
+        if path.parent == Path() and not which(f'ld.{linker}'):
+            raise FileNotFoundError(f'linker {linker}: ld.{linker} not found in PATH')
+        if path.parent != Path() and not path.is_file():
+            raise FileNotFoundError(f'linker {linker} not found')
+        name = path.name[len('ld.'):] if path.name.startswith('ld.') else path.name
+        if (threads or gdb_index or icf) and not cls.__LINKERS.get(name):
+            raise ValueError(f'linker {linker}: threads, gdb_index and icf are only supported by {", ".join(filter(cls.__LINKERS.get, cls.__LINKERS))}')
+        return ' '.join((f'-fuse-ld={linker}', *((cls.__LINKERS[name].format(threads),) if threads else ()),
+                         *(('-Wl,--gdb-index',) if gdb_index else ()), *((f'-Wl,--icf={icf}',) if icf else ())))
+
+    @classmethod
+    def __flavour_flags(cls, flavour):
+        ''' Flags of `flavour` besides its <FLAGS>_<FLAVOUR> variables
+
+            The LTO flavours link with gold, whatever the linker of the toolset and of the environments. The ThinLTO cache is kept in
+            the build directory of the flavour of each first class environment, pruned as set by `ThinLtoCachePolicy()`: incremental
+            links reuse the backend work of the objects which did not change
+        '''
+        if cls.__KIND == cls.KIND_COMPILER:
+            return (Variable('COMPILER_LAUNCHER', ''),) if flavour.startswith(cls.__UNCACHED_FLAVOURS) else ()
+        lto = (Variable('AR', '$AR_LTO'), Variable('LINKER', cls.__LTO_LINKER)) if flavour in cls.__LTO_FLAVOURS else ()
+        return (*lto, *((Flag('LDFLAGS', ('-Wl,-plugin-opt,cache-dir=', E.build_path / 'thinlto_cache')),) if flavour == 'thinlto' else ()))
+
     @classmethod
     def add_rules(cls, globals_):  #pylint: disable=missing-docstring
         gnu_rules = Path(__file__).with_name(f'gnu_{cls.__KIND}_rules.py')
-        with gnu_rules.open() as stream: #pylint: disable=no-member
-            exec(compile(stream.read(), str(gnu_rules), 'exec', optimize=0), globals_, globals_) #pylint: disable=exec-used
+        exec(compile_cached(gnu_rules), globals_, globals_) #pylint: disable=exec-used
 
 
 class BundleToolset:
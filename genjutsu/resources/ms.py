@@ -4,7 +4,7 @@ MS CL genjutsu toolset
 from itertools import chain
 from pathlib import Path
 
-from genjutsu import Alias, Apply, E, Flag, Inject, Target, Variable, escape
+from genjutsu import Alias, Apply, E, Flag, Inject, Pool, Target, Variable, escape
 
 
 _RESOURCE_DIR = Path(__file__).resolve().parent
@@ -19,6 +19,8 @@ class CompilerToolset:
     def add_rules(globals_):  #pylint: disable=missing-docstring
         globals_['CxxDef'] = lambda key, value=None: Flag('CLDEFINEFLAGS', ('/D"', key, '"="', value, '"') if value else ('/D"', key, '"'))
         globals_['IncludeDir'] = lambda path, system=False: Flag('CLINCLUDEFLAGS', ('/I', Path(path)))
+        # compiler caches (sccache, ccache) only cache the objects whose debug information is embedded (/Z7), not written to a shared PDB (/Zi)
+        globals_['CompilerLauncher'] = lambda launcher: (Variable('COMPILER_LAUNCHER', f'{launcher} ' if launcher else ''), Variable('CLDEBUGFLAGS', '/Z7' if launcher else '/Zi'))
 
         CxxFlag = globals_['CxxFlag'] = lambda *args: Flag('CLFLAGS', tuple(args)) #pylint:disable=invalid-name
 
@@ -55,6 +57,7 @@ class LinkerToolset:
     @classmethod
     def apply_to_env(cls):  #pylint: disable=missing-docstring
         Inject(lambda env, flavour: f'include {escape(_RESOURCE_DIR / "mslink.ninja_inc")}', key=cls)
+        Pool('heavy_action_pool', job_memory=2 << 30)
 
     @staticmethod
     def add_rules(globals_):  #pylint: disable=missing-docstring
@@ -0,0 +1,23 @@
+'''
+Writes a unity translation unit, including the given sources in order (see `gnu_compiler_rules.Unity`)
+
+The file is left untouched if it already includes them, so that the `unity` rule (restat) does not trigger the compilation of the batch.
+Run by path, on its own: it does not import genjutsu, run for each batch.
+usage: python unity.py OUTPUT SOURCE...
+'''
+from pathlib import Path
+import sys
+
+
+def write_unity(output, sources):  #pylint: disable=missing-docstring
+    content = ''.join(f'#include "{Path(source).as_posix()}"\n' for source in sources)
+    try:
+        if output.read_text() == content:
+            return
+    except OSError:
+        output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(content)
+
+
+if __name__ == '__main__':
+    write_unity(Path(sys.argv[1]), sys.argv[2:])
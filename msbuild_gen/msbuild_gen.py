@@ -27,8 +27,8 @@ def vcxproj_files(project_directory):  #pylint: disable=missing-docstring
     return {target_file(template_path): template_path for template_path in _RESOURCE_DIR.glob('vcxproj/**/*') if template_path.is_file()}
 
 
-def VCXProj(env, *, include_file_patterns=[], **kwargs):  #pylint: disable=invalid-name,missing-docstring,redefined-outer-name
-    from genjutsu import resolve, get_env_flags, get_target_flags
+def VCXProj(env, *, include_file_patterns=[], graph=None, **kwargs):  #pylint: disable=invalid-name,missing-docstring,redefined-outer-name
+    from genjutsu import compile_graph, resolve, get_env_flags
 
     def make_flags(flags):  #pylint: disable=missing-docstring
         flags = {flag.name: list(resolve(flag.value)) for flag in flags}
@@ -39,11 +39,12 @@ def VCXProj(env, *, include_file_patterns=[], **kwargs):  #pylint: disable=inval
         return _Flags(preprocessor_definitions, include_dirs)
 
     def make_cxx(target):  #pylint: disable=missing-docstring
-        return [_Cxx(input_, {flavour.name: make_flags(get_target_flags(target, flavour)) for flavour in target.env.all_flavours}) for input_ in target.inputs]
+        return [_Cxx(input_, {flavour.name: make_flags(graph.target_flags(target, flavour)) for flavour in target.env.all_flavours}) for input_ in target.inputs]
 
     name = env.base_dir.name
     vcproj_file = env.base_dir / (name + '.vcxproj')
-    sources = tuple(chain.from_iterable(make_cxx(target) for target in env.local_targets if target.rule == 'cxx'))
+    graph = graph or compile_graph(env)
+    sources = tuple(chain.from_iterable(make_cxx(target) for target in graph.local_targets(env) if target.rule == 'cxx'))
     includes = tuple(path.relative_to(env.base_dir) for path in chain.from_iterable(env.get_source_path().glob(pattern) for pattern in include_file_patterns))
     guid = UUID(bytes=md5(bytes(str(env.base_dir), 'utf-8')).digest(), version=4)
     flags = {flavour.name: make_flags(get_env_flags(env, flavour)) for flavour in env.all_flavours}
@@ -68,7 +69,7 @@ class Toolset:  #pylint: disable=missing-docstring
         from genjutsu import Alias, E, Inject, Target, Variable, resolve_escape_join
         Inject(lambda env, flavour: f'include {resolve_escape_join(_RESOURCE_DIR / "msbuild.ninja_inc", env=env, flavour=flavour)}', key=(cls, 0))
         if E.ninja_file:
-            Inject(lambda env, flavour: f'build {resolve_escape_join(env.build_path / "msbuild_cookie", env=env, flavour=flavour)} : msbuild_cookie {" ".join(set(resolve_escape_join(default, env=env, flavour=flavour) for default in env.all_defaults) or (flavour.name,))}', key=(cls, 1))
+            Inject(lambda env, flavour: f'build {resolve_escape_join(env.build_path / "msbuild_cookie", env=env, flavour=flavour)} : msbuild_cookie {" ".join(dict.fromkeys(resolve_escape_join(default, env=env, flavour=flavour) for default in env.all_defaults) or (flavour.name,))}', key=(cls, 1))
             Inject(lambda env, flavour: f'build {flavour.name}_msbuild_cookie : phony {resolve_escape_join(env.build_path / "msbuild_cookie", env=env, flavour=flavour)}', key=(cls, 2))
             Alias('msbuild', [Target(inputs=(E.prj_file,),
                                      implicit_inputs=(E.ninja_file,),
@@ -0,0 +1,118 @@
+''' Generation benchmarks on synthetic projects, run with --benchmark
+
+    Each scenario times :func:`parse`, the compilation of the target graph and :func:`generate` separately, then records the peak of the
+    memory traced over the three of them and the size of the generated files. Results are compared with the ones saved by a previous run
+    with --benchmark-save (in --benchmark-baseline): a measure exceeding its baseline more than --benchmark-tolerance times fails the
+    scenario. A scenario without baseline is skipped, unless saved.
+
+    The committed baseline, tests/benchmark_baseline.json, only holds the measures which do not depend on the machine, the memory peaks
+    and the generated sizes: save the timings of a machine in a baseline of its own (--benchmark-baseline) to compare them too.
+'''
+from collections import namedtuple
+import json
+from pathlib import Path
+import sys
+from time import perf_counter
+import tracemalloc
+
+import pytest
+
+import genjutsu
+from genjutsu import parse, generate, compile_graph
+
+''' envs: number of prjdefs, targets: Cxx per prjdef, flavours: flavours declared by each prjdef (on top of the toolset ones),
+    depth: length of the chains of prjdefs including each other, flags: flags per prjdef and per Cxx
+'''
+_Scenario = namedtuple('_Scenario', ('envs', 'targets', 'flavours', 'depth', 'flags'))
+
+_SCENARIOS = {
+    'envs': _Scenario(envs=64, targets=16, flavours=0, depth=1, flags=2),
+    'targets': _Scenario(envs=4, targets=1024, flavours=0, depth=1, flags=2),
+    'flavours': _Scenario(envs=8, targets=64, flavours=8, depth=1, flags=2),
+    'depth': _Scenario(envs=32, targets=16, flavours=0, depth=16, flags=2),
+    'flags': _Scenario(envs=8, targets=64, flavours=0, depth=1, flags=32),
+}
+
+_NOISE = dict(parse=0.05, graph=0.05, generate=0.05, peak=1 << 20, size=1 << 10)  # differences below are not regressions, whatever the tolerance
+
+
+def _write_project(root, scenario):
+    ''' Each prjdef builds a shared object linking the one of the next prjdef of its chain; the root prjdef links the heads of the chains '''
+    for index in range(scenario.envs):
+        child = index + 1 if (index + 1) % scenario.depth and index + 1 < scenario.envs else None
+        (root / f'e{index}').mkdir()
+        (root / f'e{index}' / 'prjdef').write_text('\n'.join((
+            f'for flavour in range({scenario.flavours}):',
+            '    Flavour(f"f{flavour}", (CxxFlag(f"-DFLAVOUR_{flavour}"),))',
+            f'Apply(*(CxxDef(f"E{index}_{{flag}}") for flag in range({scenario.flags})))',
+            f'libs = [Prjdef("../e{child}").lib]' if child is not None else 'libs = []',
+            f'objects = [Cxx(f"src/s{{target}}.cpp", flags=[CxxFlag(f"-DT{{target}}_{{flag}}") for flag in range({scenario.flags})]) for target in range({scenario.targets})]',
+            f'lib = SharedObject("e{index}", objects, libs=libs, output_flags=[LinkFlag("-Wl,-rpath,", E.build_path)])')))
+    (root / 'prjdef').write_text('\n'.join((
+        f'libs = [Prjdef(f"e{{index}}").lib for index in range(0, {scenario.envs}, {scenario.depth})]',
+        'Executable("app", [Cxx("main.cpp")], libs=libs)')))
+
+
+def _run(root):
+    ''' returns: dict: seconds spent in each phase '''
+    start = perf_counter()
+    env = parse(root).E
+    parsed = perf_counter()
+    graph = compile_graph(env)
+    for env_ in (env, *graph.first_class_subenvs(env)):
+        graph.terminal_targets(env_), graph.phony_targets(env_), graph.local_targets(env_)
+    compiled = perf_counter()
+    generate(env, graph)
+    return dict(parse=parsed - start, graph=compiled - parsed, generate=perf_counter() - compiled)
+
+
+def _generated_size(root):
+    ''' Bytes of the generated ninja files, without the paths which depend on the machine (of the project, of genjutsu, of Python) '''
+    paths = [str(path).encode() for path in (root, Path(genjutsu.__file__).resolve().parent, sys.executable)]
+    def size(path):
+        content = path.read_bytes()
+        for path_ in paths:
+            content = content.replace(path_, b'')
+        return len(content)
+    return sum(map(size, root.glob('**/*.ninja')))
+
+
+@pytest.fixture(scope='module')
+def baseline(request):
+    ''' Measures of the baseline by scenario, updated with the ones of this run if --benchmark-save '''
+    if not request.config.getoption('--benchmark'):
+        pytest.skip('benchmarks, run with --benchmark')
+    filename = request.config.getoption('--benchmark-baseline')
+    try:
+        measures = json.loads(filename.read_text())
+    except (OSError, ValueError):
+        measures = {}
+    results = {}
+    yield measures, results
+    if request.config.getoption('--benchmark-save'):
+        filename.parent.mkdir(parents=True, exist_ok=True)
+        filename.write_text(json.dumps(dict(measures, **results), indent=1, sort_keys=True))
+
+
+@pytest.mark.parametrize('name', _SCENARIOS)
+def test_generation(name, baseline, tmpdir, request, record_property):
+    previous, results = baseline
+    if name not in previous and not request.config.getoption('--benchmark-save'):
+        pytest.skip(f'{name}: no baseline in {request.config.getoption("--benchmark-baseline")}, save one with --benchmark-save')
+    root = Path(str(tmpdir))
+    _write_project(root, _SCENARIOS[name])
+    measures = _run(root)
+    tracemalloc.start()
+    try:
+        _run(root)
+        measures['peak'] = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    measures['size'] = _generated_size(root)
+    for key, value in measures.items():
+        record_property(key, value)
+
+    results[name] = measures
+    tolerance = request.config.getoption('--benchmark-tolerance')
+    regressions = {key: (previous[name][key], value) for key, value in measures.items() if key in previous.get(name, {}) and value > max(previous[name][key] * tolerance, previous[name][key] + _NOISE[key])}
+    assert not regressions, f'{name}: (baseline, measure) {regressions}'
@@ -1,8 +1,17 @@
-from contextlib import contextmanager
+from contextlib import contextmanager, nullcontext
 from pathlib import Path
+from time import perf_counter, sleep
 from tempfile import TemporaryDirectory
 from shutil import copytree
+from itertools import chain, takewhile
+import json
+import logging
+import os
+import platform
+import re
+import subprocess
 import sys
+import threading
 
 import pytest
 import pprofile
@@ -11,7 +20,8 @@ ROOT_DIR = Path(__file__).parent.resolve()
 _RESOURCE_DIR = ROOT_DIR / 'resources'
 
 sys.path.append(str(ROOT_DIR))
-from genjutsu import main as genjutsu_main
+from genjutsu import main as genjutsu_main, parse, generate, compile_cached, get_target_flags, merge_flags_iterable, Flag, Variable
+from genjutsu.genjutsu import _CODE_CACHE, _DirectoryIndex, _NinjaScope, _Resolver, _Flavour, _Filter, escape, resolve
 
 @pytest.fixture
 def profiler(request):
@@ -43,4 +53,536 @@ def test_full(profiler, tmpdir):
         build_deps_file = Path(d) / 'prjdef.ninja.d'
         assert ninja_file.is_file()
         assert build_file.is_file()
-        assert build_deps_file.is_file()
\ No newline at end of file
+        assert build_deps_file.is_file()
+
+def test_cache(profiler, tmpdir):
+    with __run_ninja(profiler, tmpdir, _RESOURCE_DIR / 'full') as d:
+        ninja_file = d / 'build.ninja'
+        mtime = ninja_file.stat().st_mtime_ns
+        genjutsu_main(args=[str(d)])
+        assert ninja_file.stat().st_mtime_ns == mtime
+        (d / 'sub' / 'prjdef').touch()
+        genjutsu_main(args=[str(d)])
+        assert ninja_file.stat().st_mtime_ns == mtime
+        with (d / 'sub' / 'prjdef').open('a') as prjdef:
+            prjdef.write('\nother_object = Cxx(\'other\')\n')
+        genjutsu_main(args=[str(d)])
+        assert ninja_file.stat().st_mtime_ns != mtime
+
+def test_cache_machine(tmpdir, monkeypatch):
+    ''' The interpreter and the machine resources written into the generated files are part of the cache key '''
+    import genjutsu.genjutsu as genjutsu_module
+    with __run_ninja(nullcontext(), tmpdir, _RESOURCE_DIR / 'full') as d:
+        monkeypatch.setattr(sys, 'executable', '/other/venv/bin/python')
+        genjutsu_main(args=[str(d)])
+        assert 'PYTHON=/other/venv/bin/python' in (d / 'build.ninja').read_text().splitlines()
+        mtime = (d / 'build.ninja').stat().st_mtime_ns
+        cpus, memory = genjutsu_module._machine_resources()
+        monkeypatch.setattr(genjutsu_module, '_machine_resources', lambda: (cpus + 1, memory))
+        genjutsu_main(args=[str(d)])
+        assert f'  depth={cpus + 1}' in (d / 'build.ninja').read_text().splitlines()
+        assert (d / 'build.ninja').stat().st_mtime_ns != mtime
+
+def test_unchanged_files_not_rewritten(profiler, tmpdir):
+    with __run_ninja(profiler, tmpdir, _RESOURCE_DIR / 'full') as d:
+        mtimes = {path: path.stat().st_mtime_ns for path in d.glob('**/*.ninja')}
+        genjutsu_main(args=[str(d), '--no-cache'])
+        assert mtimes == {path: path.stat().st_mtime_ns for path in d.glob('**/*.ninja')}
+
+def test_parallel_generation(profiler, tmpdir):
+    with __run_ninja(profiler, tmpdir, _RESOURCE_DIR / 'full') as d:
+        contents = {path: path.read_bytes() for path in d.glob('**/*.ninja*')}
+        genjutsu_main(args=[str(d), '--no-cache', '--jobs', '3'])
+        assert contents == {path: path.read_bytes() for path in d.glob('**/*.ninja*')}
+
+def test_timings(profiler, tmpdir):
+    with __run_ninja(profiler, tmpdir, _RESOURCE_DIR / 'full') as d:
+        contents = {path: path.read_bytes() for path in d.glob('**/*.ninja*')}
+        genjutsu_main(args=[str(d), '--no-cache', '--jobs', '2', '--timings', str(tmpdir / 'timings.json'), '--trace', str(tmpdir / 'trace.json')])
+        assert contents == {path: path.read_bytes() for path in d.glob('**/*.ninja*')}
+        timings = json.loads((tmpdir / 'timings.json').read_text('utf-8'))
+        assert set(timings['phase']) == {'cache', 'parse', 'graph', 'generate'}
+        assert str(d / 'prjdef') in timings['prjdef'] and timings['toolset'] and timings['flags']
+        assert set(timings['env']) == {str(path.parent) for path in d.glob('**/prjdef')}
+        assert set(timings['file']) == set(map(str, contents))
+        events = json.loads((tmpdir / 'trace.json').read_text('utf-8'))['traceEvents']
+        assert sum(event['ph'] == 'b' for event in events) == sum(event['ph'] == 'e' for event in events) == len(contents)
+        assert all(event['dur'] >= 0 for event in events if event['ph'] == 'X')
+
+def test_hoist_flags(profiler, tmpdir):
+    with __run_ninja(profiler, tmpdir, _RESOURCE_DIR / 'full') as d:
+        contents = {path: path.read_text() for path in d.glob('**/*.ninja')}
+        genjutsu_main(args=[str(d), '--hoist-flags'])
+        hoisted = 0
+        for path, content in contents.items():
+            variables, lines = {}, []
+            for line in path.read_text().splitlines(keepends=True):
+                name, _, value = line.rstrip('\n').partition('=')
+                if name.startswith('_ENV'):
+                    variables[name] = value
+                else:
+                    lines.append(re.sub(r'\$(_ENV\w+)', lambda match: variables[match.group(1)], line))
+            hoisted += len(variables)
+            assert ''.join(lines) == content
+        assert hoisted
+
+def test_shard(tmpdir):
+    run_dir = Path(str(tmpdir))
+    prjdef = '\n'.join((
+        'with env(path="src"):',
+        '    Apply(CxxDef("SRC"))',
+        '    a = Cxx("a.cpp")',
+        'with env(path="lib"):',
+        '    b = Archive("b", [Cxx("b.cpp")])',
+        'Executable("app", [Cxx("main.cpp"), a], libs=[b])'))
+    (run_dir / 'prjdef').write_text(prjdef)
+    def lines():
+        ninja_files = {path: path.read_text().splitlines() for path in run_dir.glob('**/*.ninja')}
+        return sorted(line for content in ninja_files.values() for line in content if not line.startswith('subninja')), ninja_files
+    genjutsu_main(args=[str(run_dir), '--no-cache'])
+    unsharded, _ = lines()
+    genjutsu_main(args=[str(run_dir), '--no-cache', '--shard'])
+    sharded, ninja_files = lines()
+    shards = {path.relative_to(run_dir).as_posix() for path in ninja_files if 'shards' in path.parts}
+    assert sharded == unsharded and shards == {f'build/{flavour}/shards/{directory}/local_build.ninja' for flavour in ('debug', 'release') for directory in ('src', 'lib')}
+    assert f'subninja {escape(run_dir / "build/debug/shards/src/local_build.ninja")}' in ninja_files[run_dir / 'build/debug/local_build.ninja']
+
+    mtimes = {path: path.stat().st_mtime_ns for path in ninja_files}
+    sleep(0.01)
+    (run_dir / 'prjdef').write_text(prjdef.replace('"SRC"', '"SRC2"'))
+    genjutsu_main(args=[str(run_dir), '--no-cache', '--shard'])
+    assert {path.relative_to(run_dir).as_posix() for path in ninja_files if path.stat().st_mtime_ns != mtimes[path]} == {f'build/{flavour}/shards/src/local_build.ninja' for flavour in ('debug', 'release')}
+
+def test_flavours(tmpdir):
+    ''' Flavours declared again add their flags (the compiler and linker toolsets declare both halves of debug and release), unless replaced '''
+    run_dir = Path(str(tmpdir))
+    (run_dir / 'prjdef').write_text('\n'.join((
+        'Flavour("release", [CxxFlag("-DEXTRA")])',
+        'Flavour("debug", [CxxFlag("-O1")], replace=True)',
+        'Executable("app", [Cxx("main.cpp")])')))
+    genjutsu_main(args=[str(run_dir), '--no-cache'])
+    release, debug = ((run_dir / 'build' / flavour / 'local_build.ninja').read_text().splitlines() for flavour in ('release', 'debug'))
+    assert {'CFLAGS=$CFLAGS $CFLAGS_RELEASE', 'CXXFLAGS=$CXXFLAGS $CXXFLAGS_RELEASE -DEXTRA', 'LDFLAGS=$LDFLAGS $LDFLAGS_RELEASE'} <= set(release)
+    assert [line for line in debug if 'FLAGS' in line] == ['CXXFLAGS=$CXXFLAGS -O1']
+
+def test_lto_flavours(tmpdir):
+    run_dir = Path(str(tmpdir))
+    (run_dir / 'prjdef').write_text('\n'.join((
+        'lto = Toolset("clang.Toolset0")',
+        'Flavour("thinlto", [lto.ThinLtoCachePolicy("prune_after=24h"), lto.LtoJobs(4)])',
+        'Executable("app", [Cxx("main.cpp")])')))
+    genjutsu_main(args=[str(run_dir), '--no-cache'])
+    thinlto, fulllto = ((run_dir / 'build' / flavour / 'local_build.ninja').read_text().splitlines() for flavour in ('thinlto', 'fulllto'))
+    assert {'AR=$AR_LTO', 'LINKER=-fuse-ld=gold', 'CFLAGS=$CFLAGS $CFLAGS_THINLTO'} <= set(thinlto)
+    assert {'AR=$AR_LTO', 'LINKER=-fuse-ld=gold', 'CFLAGS=$CFLAGS $CFLAGS_FULLLTO', 'LDFLAGS=$LDFLAGS $LDFLAGS_FULLLTO'} <= set(fulllto)
+    cache_dir = escape(run_dir / 'build' / 'thinlto' / 'thinlto_cache')
+    assert f'LDFLAGS=$LDFLAGS $LDFLAGS_THINLTO -Wl,-plugin-opt,cache-dir="{cache_dir}" -Wl,-plugin-opt,cache-policy=prune_after=24h -Wl,-plugin-opt,jobs=4' in thinlto
+    for flavour in ('release', 'debug'):  # declared by the default toolset and again by Toolset0
+        lines = (run_dir / 'build' / flavour / 'local_build.ninja').read_text().splitlines()
+        assert all(len(re.findall(rf'\$\w+_{flavour.upper()}\b', line)) == len(set(re.findall(rf'\$\w+_{flavour.upper()}\b', line))) for line in lines)
+        assert f'CFLAGS=$CFLAGS $CFLAGS_{flavour.upper()}' in lines
+
+def test_linker(tmpdir, monkeypatch):
+    run_dir = Path(str(tmpdir))
+    (run_dir / 'bin').mkdir()
+    for linker in ('ld.bfd', 'ld.gold', 'ld.lld'):
+        (run_dir / 'bin' / linker).touch(mode=0o755)
+    monkeypatch.setenv('PATH', f'{run_dir / "bin"}{os.pathsep}{os.environ["PATH"]}')
+    (run_dir / 'linker_toolset.py').write_text('\n'.join((
+        'from genjutsu import toolset_class',
+        '_GnuToolset = toolset_class("gnu_toolsets.GnuToolset")',
+        'class Toolset(_GnuToolset, compiler_name="clang", kind=_GnuToolset.KIND_LINKER, linker="gold"):',
+        '    pass')))
+    prjdef = '\n'.join((
+        'Toolset("linker_toolset")',
+        'Flavour("release", [Linker("lld", threads=4, gdb_index=True, icf="safe")])',
+        'Executable("app", [Cxx("main.cpp")])'))
+    (run_dir / 'prjdef').write_text(prjdef)
+    genjutsu_main(args=[str(run_dir), '--no-cache'])
+    assert 'LINKER=-fuse-ld=gold' in (run_dir / 'build.ninja').read_text().splitlines()
+    assert 'LINKER=-fuse-ld=lld$ -Wl,--threads=4$ -Wl,--gdb-index$ -Wl,--icf=safe' in (run_dir / 'build' / 'release' / 'local_build.ninja').read_text().splitlines()
+    assert 'LINKER' not in (run_dir / 'build' / 'debug' / 'local_build.ninja').read_text()
+
+    (run_dir / 'prjdef').write_text(prjdef.replace('"lld"', '"missing"'))
+    with pytest.raises(FileNotFoundError):
+        parse(run_dir)
+    (run_dir / 'prjdef').write_text(prjdef.replace('"lld"', '"bfd"'))
+    with pytest.raises(ValueError):
+        parse(run_dir)
+
+def test_link_command(tmpdir, monkeypatch):
+    ''' Link commands, as ninja runs them: the compiler driver selects the linker, by default its own one '''
+    run_dir = Path(str(tmpdir))
+    (run_dir / 'bin').mkdir()
+    (run_dir / 'bin' / 'ld.lld').touch(mode=0o755)
+    monkeypatch.setenv('PATH', f'{run_dir / "bin"}{os.pathsep}{os.environ["PATH"]}')
+    (run_dir / 'prjdef').write_text('\n'.join((
+        'Flavour("release", [Linker("lld", threads=4)])',
+        'Executable("app", [Cxx("main.cpp")])',
+        'Executable("tool", [Cxx("tool.cpp")], flags=[Linker("gold")])')))
+    genjutsu_main(args=[str(run_dir), '--no-cache'])
+    def link_command(flavour, name):
+        build_dir = run_dir / 'build' / flavour
+        lines = (build_dir / 'local_build.ninja').read_text().splitlines()
+        index = next(index for index, line in enumerate(lines) if line.startswith(f'build {escape(build_dir / name)} '))
+        bindings = [line.strip() for line in takewhile(lambda line: line.startswith('  '), lines[index + 1:])]
+        scope = _NinjaScope(lines, _NinjaScope((build_dir / 'build.ninja').read_text().splitlines()))
+        return scope.command('exe', bindings, lines[index].partition(' : exe ')[2].split(), [str(build_dir / name)]).split()
+    assert '-Wl,-z,now' in link_command('debug', 'app') and not [arg for arg in link_command('debug', 'app') if 'fuse-ld' in arg]
+    assert [arg for arg in link_command('release', 'app') if 'fuse-ld' in arg or arg.startswith('-Wl,--threads')] == ['-fuse-ld=lld', '-Wl,--threads=4']
+    assert [arg for arg in link_command('release', 'tool') if 'fuse-ld' in arg] == ['-fuse-ld=gold']
+
+def test_compdb(profiler, tmpdir):
+    with __run_ninja(profiler, tmpdir, _RESOURCE_DIR / 'full', '--compdb') as d:
+        entries = json.loads((d / 'build' / 'debug' / 'compile_commands.json').read_text())
+        assert [Path(entry['file']).name for entry in entries] == ['hello', 'sub']
+        for entry in entries:
+            assert entry['directory'] == str(d) and '$' not in entry['command']
+            assert entry['command'].startswith('clang++') and entry['command'].endswith(f' -c {entry["file"]} -o {entry["output"]}')
+        assert '-D__USE_PRECOMPILED_HEADER__' in entries[0]['command'] and '-D__USE_PRECOMPILED_HEADER__' not in entries[1]['command']
+        assert not (d / 'sub' / 'build' / 'debug' / 'compile_commands.json').exists()
+
+        genjutsu_main(args=[str(d), '--compdb-shards'])
+        shards = [json.loads((d / base_dir / 'build' / 'debug' / 'compile_commands.json').read_text()) for base_dir in ('.', 'sub')]
+        assert shards == [[entries[0]], [dict(entries[1], directory=str(d / 'sub'))]]
+
+def test_compiler_launcher(tmpdir, monkeypatch):
+    run_dir = Path(str(tmpdir))
+    (run_dir / 'prjdef').write_text('Apply(CompilerLauncher("ccache"))\nExecutable("app", [Cxx("main.cpp")])')
+    genjutsu_main(args=[str(run_dir), '--compdb'])
+    command, = (entry['command'] for entry in json.loads((run_dir / 'build' / 'debug' / 'compile_commands.json').read_text()))
+    assert command.startswith('clang++') and f' -fdebug-prefix-map="{run_dir}"=. ' in command  # the launcher is left out of the database
+    local_build = (run_dir / 'build' / 'debug' / 'local_build.ninja').read_text()
+    assert f'\nCOMPILER_LAUNCHER=CCACHE_BASEDIR="{run_dir}"$ ccache$ \n' in local_build
+    monkeypatch.setattr(platform, 'system', lambda: 'Windows')  # no shell to set the variable
+    assert parse(run_dir).E.flags[0] == Variable('COMPILER_LAUNCHER', ('ccache', ' '))
+
+def test_msvc_compiler_launcher(tmpdir, monkeypatch):
+    ''' With MSVC, objects compiled through a compiler cache embed their debug information (/Z7): caches do not handle shared PDBs (/Zi) '''
+    import genjutsu.genjutsu as genjutsu_module
+    monkeypatch.setattr(genjutsu_module, '_TOOLSETS', ('ms',))
+    monkeypatch.setattr(genjutsu_module, '_LOADED_TOOLSETS', ())
+    run_dir = Path(str(tmpdir))
+    (run_dir / 'prjdef').write_text('\n'.join((
+        'Apply(CompilerLauncher("sccache"))',
+        'Cxx("main.cpp")',
+        'with env(path="sub"):',
+        '    Apply(CompilerLauncher(None))',
+        '    Cxx("sub.cpp")')))
+    genjutsu_main(args=[str(run_dir), '--no-cache'])
+    build_dir = run_dir / 'build' / 'default'
+    lines = (build_dir / 'local_build.ninja').read_text().splitlines()
+    scope = _NinjaScope(lines, _NinjaScope((build_dir / 'build.ninja').read_text().splitlines()))
+    def command(source):
+        index = next(index for index, line in enumerate(lines) if line.endswith(f' : cxx {escape(run_dir / source)}   '))
+        bindings = [line.strip() for line in takewhile(lambda line: line.startswith('  '), lines[index + 1:])]
+        return scope.command('cxx', bindings, [str(run_dir / source)], ['out.obj']).split()
+    assert command('main.cpp')[0] == 'sccache' and '/Z7' in command('main.cpp') and '/Zi' not in command('main.cpp')
+    assert command('sub/sub.cpp')[0] != 'sccache' and '/Zi' in command('sub/sub.cpp') and '/Z7' not in command('sub/sub.cpp')
+
+def test_ninja_scope(tmpdir):
+    scope = _NinjaScope(('A=a', 'B = $A$ b$:$$ $', '  c', 'rule r', '  description=$D', '  command=$B ${C} $D $in > $out', '  D=d$C'))
+    assert scope.lookup('B') == 'a b:$ c' and scope.lookup('C') == ''
+    (Path(str(tmpdir)) / 'included.ninja').write_bytes('# Remarque\xa0: not UTF-8\nE=e\n'.encode('latin-1'))
+    assert _NinjaScope((f'include {escape(Path(str(tmpdir)) / "included.ninja")}',)).lookup('E') == 'e'
+    scope = _NinjaScope(('A=$A sub', 'C=c'), scope)
+    assert scope.command('r', ('B=$A', 'C=$C edge'), ('in', "it's"), ('out',)) == "a sub c edge dc edge in 'it'\\''s' > out"
+
+def test_resolver(monkeypatch):
+    class Env(object):
+        def __init__(self, base_dir):
+            self.base_dir = base_dir
+    class Target(object):
+        def __init__(self, env, outputs):
+            self.env, self.outputs = env, outputs
+    env, flavour = Env(Path('/src dir')), _Flavour('debug', ())
+    target = Target(Env(Path('/other')), (Path('lib_{flavour}.so'), 'out:put'))
+    def values():
+        return [Path('a.cpp'), [Path('obj/{flavour}/a.o'), 'x {flavour}', ('{{}}', 3)], target, _Filter((), [target, Path('/abs')]), flavour, (path for path in (Path('g'),)), Path('a.cpp')]
+    for size in (1 << 14, 1):
+        monkeypatch.setattr('genjutsu.genjutsu._RESOLVED_PATHS', size)
+        resolver = _Resolver(env, flavour)
+        for _ in range(2):  # the second time from the cache, if any
+            assert resolver.join(values()) == ' '.join(escape(item) for item in resolve(values(), env=env, flavour=flavour))
+            assert resolver.join_flag(values()) == ''.join(str(item) for item in resolve(values(), env=env, flavour=flavour, quote_paths=True))
+
+def test_daemon(profiler, tmpdir, caplog):
+    caplog.set_level(logging.INFO)
+    with __run_ninja(profiler, tmpdir, _RESOURCE_DIR / 'full') as d:
+        daemon = subprocess.Popen([sys.executable, '-m', 'genjutsu', '--daemon', str(d)], cwd=str(ROOT_DIR.parent), env={**os.environ, 'PYTHONPATH': str(ROOT_DIR.parent)})
+        try:
+            deadline = perf_counter() + 60
+            while not (d / '.genjutsu_daemon').exists():
+                assert daemon.poll() is None and perf_counter() < deadline
+                sleep(0.1)
+            genjutsu_main(args=[str(d), '--client'])
+            assert '0 file(s) rewritten, 14 unchanged (daemon)' in caplog.text
+            with (d / 'sub' / 'prjdef').open('a') as prjdef:
+                prjdef.write('\nother_object = Cxx(\'other\')\n')
+            genjutsu_main(args=[str(d), '--client'])
+            assert 'other' in (d / 'sub' / 'build' / 'debug' / 'local_build.ninja').read_text()
+            genjutsu_main(args=[str(d), '--client', '--builddir', 'elsewhere'])  # other options: generated in process
+            assert caplog.text.count('(daemon)') == 2
+        finally:
+            daemon.terminate()
+            daemon.wait()
+        assert not (d / '.genjutsu_daemon').exists()
+
+def test_deep_library_chain(tmpdir, record_property):
+    ''' Each library links the two previous ones: the number of paths to the first ones grows exponentially with the depth '''
+    depth = 40
+    run_dir = Path(str(tmpdir))
+    (run_dir / 'prjdef').write_text('\n'.join((
+        'libs = []',
+        f'for i in range({depth}):',
+        '    libs.append(SharedObject(f"lib{i}", [Cxx(f"lib{i}.cpp")], libs=libs[-2:], output_flags=[LinkFlag("-Wl,-rpath,", E.build_path / str(i))]))',
+        'Executable("app", [Cxx("main.cpp")], libs=libs[-2:])')))
+    env = parse(run_dir).E
+    start = perf_counter()
+    generate(env)
+    record_property('generate_seconds', perf_counter() - start)
+    lines = (run_dir / 'build' / 'debug' / 'local_build.ninja').read_text().splitlines()
+    app = next(index for index, line in enumerate(lines) if line.startswith('build ') and ' : exe ' in line and '/app ' in line)
+    assert lines[app + 1].count('-rpath') == depth
+
+def test_diamond_link_order(tmpdir):
+    ''' A library reached through several paths is linked after every library depending on it '''
+    run_dir = Path(str(tmpdir))
+    (run_dir / 'prjdef').write_text('\n'.join((
+        'c = Target([], ["libc.a"], "ar", output_flags=[Flag("LIBS", "-lc")])',
+        'b = Target([c], ["libb.a"], "ar", output_flags=[Flag("LIBS", "-lb")])',
+        'a = Target([c], ["liba.a"], "ar", output_flags=[Flag("LIBS", "-la")])',
+        'app = Target([c, b, a], ["app"], "exe")')))
+    env = parse(run_dir).E
+    app = next(target for target in env.targets if target.rule == 'exe')
+    flags = {flag.name: flag.value for flag in get_target_flags(app, next(iter(env.all_flavours)))}
+    assert flags['LIBS'] == ('-lb', '-la', '-lc')
+
+def test_unity(tmpdir):
+    run_dir = Path(str(tmpdir))
+    def batches(sources):
+        (run_dir / 'prjdef').write_text(f'objects = Unity([f"s{{index}}.cpp" for index in {sources!r}], batch_size=8)\nExecutable("app", objects)')
+        return [tuple(source.name for source in target.inputs) for target in parse(run_dir).E.targets if target.rule == 'unity']
+    before = batches(list(range(100)))
+    assert sorted(chain.from_iterable(before)) == sorted(f's{index}.cpp' for index in range(100)) and all(len(batch) <= 16 for batch in before)
+    assert batches(list(reversed(range(100)))) == [batch[::-1] for batch in before]  # same batches, sources included in the given order
+    after = batches([*range(100), 1000])  # sorted after s100.cpp
+    assert 0 < len(set(after) - set(before)) <= 3 < len(before) // 4
+
+    generate(parse(run_dir).E)
+    common_lines = (run_dir / 'common_build.ninja').read_text().splitlines()
+    assert sum(' : unity ' in line for line in common_lines) == len(after)
+    assert (run_dir / 'build' / 'debug' / 'build.ninja').read_text().count(' : phony ') == 101
+    output, _, inputs = next(line for line in common_lines if ' : unity ' in line)[len('build '):].partition(' : unity ')
+    command = _NinjaScope((run_dir / 'build.ninja').read_text().splitlines()).command('unity', (), inputs.split(), [output.strip()])
+    subprocess.run(command, shell=True, check=True)  # the script alone, by path
+    assert Path(output.strip()).read_text().splitlines() == [f'#include "{Path(input_).as_posix()}"' for input_ in inputs.split()]
+
+def test_pools(tmpdir, monkeypatch):
+    import genjutsu.genjutsu as genjutsu_module
+    monkeypatch.setattr(genjutsu_module, '_machine_resources', lambda: (8, 64 << 30))
+    run_dir = Path(str(tmpdir))
+    (run_dir / 'sub').mkdir()
+    (run_dir / 'sub' / 'prjdef').write_text('Pool("codegen", depth=2)\nobject = Cxx("sub.cpp")')
+    (run_dir / 'prjdef').write_text('\n'.join((
+        'Pool("codegen", depth=3)',
+        'link_pool = Pool("huge_link_{flavour}", job_memory=1 << 60)',
+        'Executable("app", [Cxx("main.cpp"), Prjdef("sub").object], flags=[link_pool])',
+        'Pool("test_{flavour}")',
+        'Executable("tool", [Pch("pch.h").outputs[0]])',
+        'Target(["schema.xml"], ["schema.cpp"], "codegen", flags=[Pool("gen_{flavour}", depth=2)])')))
+    generate(parse(run_dir).E)
+    build = (run_dir / 'build' / 'debug' / 'build.ninja').read_text()
+    assert 'pool codegen\n  depth=3\n' in build and 'pool huge_link_debug\n  depth=1\n' in build and 'huge_link_release' not in build
+    assert 'pool link\n  depth=8\n' in build and 'pool pch\n  depth=8\n' in build and 'pool test_debug\n  depth=2\n' in build
+    main_build = (run_dir / 'build.ninja').read_text()  # every flavour: the computed depths of the pools of a flavour are shared, as in the build file of each flavour
+    assert 'pool huge_link_release\n  depth=1\n' in main_build and 'pool link\n  depth=8\n' in main_build
+    assert 'pool test_debug\n  depth=2\n' in main_build and 'pool test_release\n  depth=2\n' in main_build
+    # targets which do not depend on the flavour (in the common build file) go to the pool of the default flavour
+    assert re.search(r'schema.cpp .*\n(  .*\n)*  pool=gen_default\n', (run_dir / 'common_build.ninja').read_text())
+    assert all('pool gen_default\n  depth=2\n' in build_ for build_ in (build, main_build))
+    local_build = (run_dir / 'build' / 'debug' / 'local_build.ninja').read_text()
+    assert re.search(r'/app .*\n(  .*\n)*  pool=huge_link_debug\n', local_build) and re.search(r'/tool .*\n(  .*\n)*  pool=link\n', local_build)
+    assert re.search(r'/pch.pch .*\n(  .*\n)*  pool=pch\n', local_build)
+
+def test_concurrent_prjdefs(tmpdir):
+    run_dir = Path(str(tmpdir))
+    (run_dir / 'common').mkdir()
+    (run_dir / 'common' / 'prjdef').write_text('object = Cxx("common.cpp")')
+    names = [f'p{index}' for index in range(8)]
+    for index, name in enumerate(names):
+        (run_dir / name).mkdir()
+        (run_dir / name / 'prjdef').write_text('\n'.join((
+            'common, = Prjdefs(["../common"])',
+            f'nested = Prjdefs(["../{names[index - 1]}"]) if {index} % 4 == 1 else ()',
+            f'lib = SharedObject("{name}", [Cxx("{name}.cpp"), common.object])')))
+    (run_dir / 'prjdef').write_text(f'prjdefs = Prjdefs({names!r})\nExecutable("app", [Cxx("main.cpp")], libs=[prjdef.lib for prjdef in prjdefs])')
+    prjdef = parse(run_dir)
+    assert [subenv.base_dir.name for subenv in prjdef.E.subenvs] == names
+    assert len({id(prjdef_.common) for prjdef_ in prjdef.prjdefs}) == 1 and prjdef.prjdefs[1].nested[0] is prjdef.prjdefs[0]
+    assert all((run_dir / name / 'prjdef').resolve() in prjdef.E.dependencies for name in (*names, 'common'))
+    assert not [thread for thread in threading.enumerate() if thread.name.startswith('prjdef')]  # no thread left for --jobs to fork
+
+    (run_dir / 'common' / 'prjdef').write_text('Prjdefs(["../p0"])')
+    with pytest.raises(RecursionError):
+        parse(run_dir)
+    assert not [thread for thread in threading.enumerate() if thread.name.startswith('prjdef')]
+
+def test_sealed_env(tmpdir):
+    run_dir = Path(str(tmpdir))
+    (run_dir / 'sub').mkdir()
+    (run_dir / 'sub' / 'prjdef').write_text('Apply(CxxDef("SUB"))\nwith env(path="src"):\n    Cxx("a.cpp")\n')
+    (run_dir / 'prjdef').write_text('Prjdef("sub")\nPrjdef("sub")\nExecutable("app", [Cxx("main.cpp")])')
+    env = parse(run_dir).E
+    assert env.sealed and all(subenv.sealed for subenv in env.all_subenvs)
+    assert env.dependencies is env.dependencies and env.all_subenvs is env.all_subenvs
+    assert {path.name for path in env.dependencies} >= {'prjdef', 'genjutsu.py'} and len(env.all_subenvs) == 2
+    with pytest.raises(RuntimeError):
+        env.add_dependency(run_dir / 'other')
+    with pytest.raises(RuntimeError):
+        next(iter(env.all_subenvs)).add_flag(Flag('CXXFLAGS', '-O3'))
+
+def test_memory_ceiling(request, tmpdir, record_property):
+    ''' Peak memory of the generation of 100k targets, above the one of the parsing: generated files are streamed, not held in memory '''
+    if not request.config.getoption('--large'):
+        pytest.skip('large synthetic project, run with --large')
+    run_dir = Path(str(tmpdir))
+    (run_dir / 'prjdef').write_text('\n'.join((
+        'for i in range(100):',
+        '    with env(path=f"d{i}"):',
+        '        Archive(f"l{i}", [Cxx(f"s{j}.cpp", quick_build_alias=None) for j in range(1000)])')))
+    (run_dir / 'measure.py').write_text('\n'.join((
+        'from pathlib import Path',
+        'import resource, sys',
+        'from genjutsu import parse, generate',
+        'env = parse(Path(sys.argv[1])).E',
+        'parsed = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss',
+        'generate(env)',
+        'print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - parsed)')))
+    output = subprocess.run([sys.executable, str(run_dir / 'measure.py'), str(run_dir)], stdout=subprocess.PIPE, check=True, cwd=str(ROOT_DIR.parent), env={**os.environ, 'PYTHONPATH': str(ROOT_DIR.parent)}).stdout
+    peak = int(output.splitlines()[-1]) * (1 if sys.platform == 'darwin' else 1024)  # ru_maxrss is in bytes on macOS, in KiB elsewhere
+    record_property('generate_peak_bytes', peak)
+    assert peak < 64 * 1024 * 1024
+
+def test_directory_index(tmpdir):
+    root = Path(str(tmpdir))
+    for path in ('src/a.cpp', 'src/b.h', 'src/sub/c.cpp', 'src/.hidden/d.cpp', 'include/e.h', 'f.cpp'):
+        (root / path).parent.mkdir(parents=True, exist_ok=True)
+        (root / path).touch()
+    (root / 'link').symlink_to(root / 'src', target_is_directory=True)
+    (root / 'broken').symlink_to(root / 'missing')
+    index, index_file = _DirectoryIndex(), root / 'index'
+    for pattern in ('*', '**', '**/*.cpp', '*/*.h', 'src/**/', 'link/*.cpp', 'link/**/*.cpp', 'src/../include/*.h', 'broken', 'missing/*', '[si]*/?.*'):
+        assert [root / path for path in index.glob(root, pattern)] == list(root.glob(pattern))
+    index.save(index_file)
+
+    def set_mtime(directory, mtime):
+        os.utime(str(directory), ns=(mtime, mtime))
+    mtime = (root / 'src').stat().st_mtime_ns - 3600 * 10 ** 9
+    set_mtime(root / 'src', mtime)
+    index = _DirectoryIndex()
+    index.load(index_file)
+    assert list(index.glob(root, 'src/*.cpp')) == [str(Path('src/a.cpp'))]
+    index.save(index_file)
+    (root / 'src' / 'g.cpp').touch()
+    set_mtime(root / 'src', mtime)
+    index = _DirectoryIndex()
+    index.load(index_file)
+    assert list(index.glob(root, 'src/*.cpp')) == [str(Path('src/a.cpp'))]  # unchanged mtime: not scanned again
+    set_mtime(root / 'src', mtime + 1)
+    index.new_run()
+    assert sorted(index.glob(root, 'src/*.cpp')) == [str(Path('src/a.cpp')), str(Path('src/g.cpp'))]
+
+def test_concurrent_directory_index(tmpdir, monkeypatch):
+    ''' Directories are scanned concurrently (as on a network file system, here 100ms per listing), each of them once '''
+    import genjutsu.genjutsu as genjutsu_module
+    root = Path(str(tmpdir))
+    for name in ('a', 'b', 'c', 'd'):
+        (root / name).mkdir()
+        (root / name / f'{name}.cpp').touch()
+    scanned, scandir = [], genjutsu_module.scandir
+    def slow_scandir(directory):
+        scanned.append(directory)
+        sleep(0.1)
+        return scandir(directory)
+    monkeypatch.setattr(genjutsu_module, 'scandir', slow_scandir)
+    index, results = _DirectoryIndex(), {}
+    def glob(name):
+        results[name] = list(index.glob(root / name, '*.cpp'))
+    threads = [threading.Thread(target=glob, args=(name,)) for name in ('a', 'b', 'c', 'd', 'a', 'b', 'c', 'd')]
+    start = perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert perf_counter() - start < 0.3
+    assert results == {name: [f'{name}.cpp'] for name in ('a', 'b', 'c', 'd')} and len(scanned) == 4
+
+@pytest.mark.parametrize('audited', (pytest.param(True, marks=pytest.mark.skipif(not hasattr(sys, 'addaudithook'), reason='Python 3.8+')), False))
+def test_prjdef_dependencies(tmpdir, audited):
+    ''' Files recorded as dependencies: included prjdefs, imported modules and files read, with audit hooks or below Python 3.8 '''
+    run_dir = Path(str(tmpdir))
+    helper = f'dependencies_helper_{audited:d}'
+    (run_dir / 'sub').mkdir()
+    (run_dir / 'sub' / 'prjdef').write_text('x = 1\n')
+    (run_dir / f'{helper}.py').write_text('y = 2\n')
+    (run_dir / 'data.txt').write_text('z')
+    (run_dir / 'prjdef').write_text('\n'.join((
+        'import sys',
+        'sys.path.insert(0, str(__prjdef__.parent))',
+        f'import {helper}',
+        'Prjdef("sub")',
+        'data = (__prjdef__.parent / "data.txt").read_text()')))
+    script = '\n'.join((
+        'import json, sys',
+        'from pathlib import Path',
+        '' if audited else 'vars(sys).pop("addaudithook", None)',
+        'from genjutsu import parse',
+        'import builtins',
+        'import_ = builtins.__import__',
+        'env = parse(Path(sys.argv[1])).E',
+        'assert builtins.__import__ is import_',
+        'print(json.dumps([sorted(map(str, env.dependencies)), sorted(map(str, env.subenvs[0].dependencies))]))'))
+    dependencies, sub_dependencies = json.loads(subprocess.run([sys.executable, '-c', script, str(run_dir)], cwd=str(ROOT_DIR.parent), check=True, stdout=subprocess.PIPE).stdout)
+    assert {str(run_dir / name) for name in ('prjdef', 'sub/prjdef', f'{helper}.py', 'data.txt')} <= set(dependencies)
+    assert str(run_dir / 'sub' / 'prjdef') in sub_dependencies and str(run_dir / 'data.txt') not in sub_dependencies
+
+def test_compile_cached(tmpdir, monkeypatch):
+    import genjutsu.genjutsu as genjutsu_module
+    monkeypatch.setattr(sys, 'dont_write_bytecode', False)
+    source = Path(str(tmpdir)) / 'src' / 'prjdef'
+    source.parent.mkdir()
+    def run():
+        globals_ = {}
+        exec(compile_cached(source), globals_)
+        return globals_['x']
+    source.write_text('x = 1\n')
+    assert run() == 1 and list(source.parent.iterdir()) == [source]  # in memory only, nothing written next to the sources
+    monkeypatch.setattr(genjutsu_module, '_BYTECODE_DIR', Path(str(tmpdir)) / 'build' / '__pycache__')
+    _CODE_CACHE.clear()
+    assert run() == 1 and list(source.parent.iterdir()) == [source]
+    cache, = genjutsu_module._BYTECODE_DIR.glob(f'prjdef.*.{sys.implementation.cache_tag}.pyc')
+    content, written = cache.read_bytes(), cache.stat().st_mtime_ns
+    _CODE_CACHE.clear()
+    assert run() == 1 and cache.stat().st_mtime_ns == written  # loaded, not compiled and written again
+    source.write_text('x = 2\n')
+    assert run() == 2 and cache.read_bytes() != content
+    monkeypatch.setattr(genjutsu_module, 'getpreferredencoding', lambda do_setlocale: 'cp1252')
+    source.write_bytes('x = "\u00e9"\n'.encode('cp1252'))  # decoded with the locale encoding, as open() does
+    assert run() == '\u00e9'
+
+def test_bytecode_builddir(tmpdir, monkeypatch):
+    import genjutsu.genjutsu as genjutsu_module
+    monkeypatch.setattr(sys, 'dont_write_bytecode', False)
+    for name in ('_BUILD_DIR', '_BYTECODE_DIR'):
+        monkeypatch.setattr(genjutsu_module, name, getattr(genjutsu_module, name))
+    with __run_ninja(nullcontext(), tmpdir, _RESOURCE_DIR / 'empty', '--no-cache') as d:
+        assert list((d / 'build' / '__pycache__').glob('prjdef.*.pyc'))
+        _CODE_CACHE.clear()
+        genjutsu_main(args=[str(d), '--no-cache', '--builddir', 'out'])
+        assert list((d / 'out' / '__pycache__').glob('prjdef.*.pyc'))
+
+def test_merge_flags():
+    flags = merge_flags_iterable((Flag('B', 'b0'), Flag('A', 'a0'), Flag('A', 'a1'), Variable('B', 'b1'), Flag('B', 'b2'), Flag('C', ''), Flag('C', 'c0'), Flag('A', 'a2')))
+    assert [(flag.name, flag.value, flag.append) for flag in flags] == [('A', ('a0', 'a1', 'a2'), True), ('B', ('b1', 'b2'), True), ('C', 'c0', True)]
+    assert merge_flags_iterable((Flag('A', 'a0'), Variable('A', 'a1'))) == [Variable('A', 'a1')]